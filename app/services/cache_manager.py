@@ -47,10 +47,11 @@ class VideoCacheManager:
         # 仅使用文件名和文件属性，避免完整路径可能导致的不一致
         file_name = os.path.basename(abs_path)
         
-        # 使用文件属性
+        # 使用文件属性（一次stat同时取得修改时间和大小）
         try:
-            mtime = os.path.getmtime(abs_path)
-            file_size = os.path.getsize(abs_path) 
+            stat = os.stat(abs_path)
+            mtime = stat.st_mtime
+            file_size = stat.st_size
         except (OSError, IOError):
             mtime = 0
             file_size = 0
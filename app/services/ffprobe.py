@@ -1,10 +1,22 @@
 import os
-import json
-import re
+import functools
 import subprocess
 import shutil
 from loguru import logger
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时退回标准库，json.loads同样接受bytes
+    import json as orjson
+
+# 所有元数据查询共用同一组参数：-show_streams默认包含side_data_list（Display Matrix），
+# 一次探测即可得到宽高、编码、时长、帧率、音频和旋转信息，且同一文件只占一个缓存项；
+# -show_data_hash让流信息附带extradata（SPS/PPS）的校验值，用于判断素材能否直接流复制合并
+_FULL_PROBE_ARGS = (
+    "-v", "error", "-show_format", "-show_streams", "-show_data_hash", "CRC32", "-of", "json"
+)
+
 
 class FFprobeExtractor:
     """使用FFprobe工具提取视频元数据的实现类"""
@@ -33,21 +45,20 @@ class FFprobeExtractor:
             cmd = ["ffprobe"] + args + [file_path]
             logger.debug(f"🔍 执行命令: {' '.join(cmd)}")
             
+            # 保持stdout为bytes，直接交给JSON解析器，省去解码产生的中间字符串
             result = subprocess.run(
                 cmd, 
                 capture_output=True, 
-                encoding='utf-8', 
-                errors='replace',
                 timeout=timeout
             )
             
             if result.returncode != 0:
-                logger.error(f"❌ ffprobe执行失败: {result.stderr}")
+                logger.error(f"❌ ffprobe执行失败: {result.stderr.decode('utf-8', errors='replace')}")
                 return None
             
             try:
-                return json.loads(result.stdout)
-            except json.JSONDecodeError as e:
+                return orjson.loads(result.stdout)
+            except ValueError as e:
                 logger.error(f"❌ 解析ffprobe JSON输出失败: {str(e)}")
                 return None
         except Exception as e:
@@ -55,16 +66,56 @@ class FFprobeExtractor:
             return None
     
     @staticmethod
-    def get_basic_metadata(file_path: str) -> Dict[str, Any]:
+    def _execute_ffprobe_cached(file_path: str, args: list, timeout: int = 30) -> Optional[Dict]:
         """
-        获取媒体文件的基本元数据（宽高、编码、旋转角度等）
+        带缓存的ffprobe调用，以(绝对路径, 修改时间, 文件大小)为键，文件未变化时直接返回上次结果
         
-        Args:
-            file_path: 媒体文件路径
-            
-        Returns:
-            包含基本元数据的字典
+        返回的字典为缓存共享对象，调用方只能读取不能修改。
         """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            logger.error(f"❌ 文件不存在: {file_path}")
+            return None
+        
+        try:
+            return _probe_cached(os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size, tuple(args), timeout)
+        except _ProbeError:
+            return None
+    
+    @staticmethod
+    def _probe_full(file_path: str) -> Tuple[Optional[Dict], Optional[Dict]]:
+        """执行（或命中缓存的）完整探测，返回(探测数据, 第一个视频流)"""
+        data = FFprobeExtractor._execute_ffprobe_cached(file_path, list(_FULL_PROBE_ARGS))
+        streams = data.get("streams", []) if data else []
+        video_stream = next((s for s in streams if s.get("codec_type") == "video"), None)
+        return data, video_stream
+    
+    @staticmethod
+    def _parse_rotation(video_stream: Dict[str, Any]) -> Optional[int]:
+        """从ffprobe视频流信息中解析旋转角度（rotate标签或Display Matrix），未找到返回None"""
+        rotate_tag = video_stream.get("tags", {}).get("rotate")
+        if rotate_tag:
+            try:
+                return FFprobeExtractor.normalize_rotation(float(rotate_tag))
+            except (ValueError, TypeError):
+                pass
+        
+        # 按类型查找Display Matrix，不依赖它在side_data_list中的位置
+        side_data_list = video_stream.get("side_data_list", [])
+        for side_data in side_data_list:
+            if side_data.get("side_data_type") == "Display Matrix" and "rotation" in side_data:
+                return FFprobeExtractor.normalize_rotation(side_data["rotation"])
+        
+        for side_data in side_data_list:
+            if "rotation" in side_data:
+                return FFprobeExtractor.normalize_rotation(side_data.get("rotation", 0))
+        
+        return None
+    
+    @staticmethod
+    def _build_basic_metadata(data: Optional[Dict], video_stream: Optional[Dict]) -> Dict[str, Any]:
+        """根据一次ffprobe的输出构建基本元数据字典"""
         # 初始化基本元数据字典
         metadata = {
             "width": 0,
@@ -78,16 +129,6 @@ class FFprobeExtractor:
             "is_portrait": False
         }
         
-        # 获取基本流信息
-        args = [
-            "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=width,height,codec_name,r_frame_rate,duration",
-            "-show_entries", "format=duration",
-            "-of", "json"
-        ]
-        
-        data = FFprobeExtractor._execute_ffprobe(file_path, args)
         if not data:
             return metadata
         
@@ -100,10 +141,7 @@ class FFprobeExtractor:
                 pass
         
         # 提取视频流信息
-        streams = data.get("streams", [])
-        if streams:
-            video_stream = streams[0]  # 我们选择了v:0，所以只有一个流
-            
+        if video_stream:
             # 提取宽高
             metadata["width"] = int(video_stream.get("width", 0))
             metadata["height"] = int(video_stream.get("height", 0))
@@ -117,9 +155,9 @@ class FFprobeExtractor:
                     metadata["duration"] = float(video_stream["duration"])
                 except (ValueError, TypeError):
                     pass
-        
-        # 获取旋转信息
-        metadata["rotation"] = FFprobeExtractor.extract_rotation(file_path)
+            
+            # 旋转信息与宽高来自同一次探测
+            metadata["rotation"] = FFprobeExtractor._parse_rotation(video_stream) or 0
         
         # 计算宽高比
         if metadata["height"] > 0:
@@ -136,8 +174,26 @@ class FFprobeExtractor:
         # 判断是否为竖屏
         metadata["is_portrait"] = effective_height > effective_width
         
-        logger.info(f"🎬 FFprobe基本元数据获取成功: 宽={metadata['width']}, 高={metadata['height']}, " + 
-                   f"旋转={metadata['rotation']}°, 编码={metadata['codec']}")
+        return metadata
+    
+    @staticmethod
+    def get_basic_metadata(file_path: str) -> Dict[str, Any]:
+        """
+        获取媒体文件的基本元数据（宽高、编码、旋转角度等）
+        
+        Args:
+            file_path: 媒体文件路径
+            
+        Returns:
+            包含基本元数据的字典
+        """
+        # 与详细元数据共用同一次探测，同一文件先后调用两者时只启动一次ffprobe
+        data, video_stream = FFprobeExtractor._probe_full(file_path)
+        
+        metadata = FFprobeExtractor._build_basic_metadata(data, video_stream)
+        if data:
+            logger.info(f"🎬 FFprobe基本元数据获取成功: 宽={metadata['width']}, 高={metadata['height']}, " + 
+                       f"旋转={metadata['rotation']}°, 编码={metadata['codec']}")
         
         return metadata
     
@@ -146,14 +202,19 @@ class FFprobeExtractor:
         """
         获取媒体文件的详细元数据（包括帧率、时长、音频信息等）
         
+        只执行一次ffprobe，基本元数据、旋转角度与详细信息都从同一份输出中解析。
+        
         Args:
             file_path: 媒体文件路径
             
         Returns:
             包含详细元数据的字典
         """
-        # 获取基本元数据
-        metadata = FFprobeExtractor.get_basic_metadata(file_path)
+        data, video_stream = FFprobeExtractor._probe_full(file_path)
+        streams = data.get("streams", []) if data else []
+        
+        # 基本元数据
+        metadata = FFprobeExtractor._build_basic_metadata(data, video_stream)
         
         # 添加详细元数据的默认值
         detailed_metadata = {
@@ -162,6 +223,7 @@ class FFprobeExtractor:
             "bit_depth": 0,
             "color_space": "",
             "pixel_format": "",
+            "color_range": "",
             "audio_codec": "unknown",
             "audio_channels": 0,
             "audio_sample_rate": 0,
@@ -171,20 +233,10 @@ class FFprobeExtractor:
             "is_standard_landscape": False
         }
         
-        # 获取详细信息
-        args = [
-            "-v", "error",
-            "-show_format",
-            "-show_streams",
-            "-of", "json"
-        ]
-        
-        data = FFprobeExtractor._execute_ffprobe(file_path, args)
         if not data:
             return detailed_metadata
         
         # 处理视频流
-        video_stream = next((s for s in data.get("streams", []) if s.get("codec_type") == "video"), None)
         if video_stream:
             # 提取帧率
             if "r_frame_rate" in video_stream:
@@ -197,6 +249,7 @@ class FFprobeExtractor:
             # 提取像素格式和色彩空间
             detailed_metadata["pixel_format"] = video_stream.get("pix_fmt", "")
             detailed_metadata["color_space"] = video_stream.get("color_space", "")
+            detailed_metadata["color_range"] = video_stream.get("color_range", "")
             
             # 提取位深度
             if "bits_per_raw_sample" in video_stream and video_stream["bits_per_raw_sample"]:
@@ -219,7 +272,7 @@ class FFprobeExtractor:
             detailed_metadata["is_standard_landscape"] = 1.7 < aspect_ratio < 1.8
         
         # 处理音频流
-        audio_stream = next((s for s in data.get("streams", []) if s.get("codec_type") == "audio"), None)
+        audio_stream = next((s for s in streams if s.get("codec_type") == "audio"), None)
         if audio_stream:
             detailed_metadata["audio_codec"] = audio_stream.get("codec_name", "unknown")
             detailed_metadata["audio_channels"] = int(audio_stream.get("channels", 0))
@@ -237,67 +290,13 @@ class FFprobeExtractor:
     def extract_rotation(file_path: str) -> int:
         """提取视频旋转角度信息"""
         try:
-            # 尝试从流标签中获取rotation
-            cmd = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream_tags=rotate",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                file_path
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, encoding='utf-8', errors='replace')
-            
-            if result.returncode == 0 and result.stdout.strip():
-                try:
-                    rotation = int(float(result.stdout.strip()))
-                    return FFprobeExtractor.normalize_rotation(rotation)
-                except ValueError:
-                    pass
-            
-            # 检查side_data_list中的Display Matrix
-            cmd = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_streams",
-                "-of", "json",
-                file_path
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, encoding='utf-8', errors='replace')
-            
-            if result.returncode == 0:
-                data = json.loads(result.stdout)
-                video_stream = next((s for s in data.get("streams", []) if s.get("codec_type") == "video"), None)
-                
-                if video_stream:
-                    side_data_list = video_stream.get("side_data_list", [])
-                    for side_data in side_data_list:
-                        if side_data.get("side_data_type") == "Display Matrix":
-                            rotation = float(side_data.get("rotation", 0))
-                            return FFprobeExtractor.normalize_rotation(rotation)
-            
-            # 使用ffmpeg命令检查（最后的尝试）
-            cmd = ["ffmpeg", "-i", file_path, "-hide_banner"]
-            result = subprocess.run(cmd, capture_output=True, encoding='utf-8', errors='replace')
-            stderr_text = result.stderr
-            
-            rotation_patterns = [
-                r'rotate\s*:\s*(-?\d+(?:\.\d+)?)',
-                r'rotation\s*:\s*(-?\d+(?:\.\d+)?)',
-                r'Rotation\s*:\s*(-?\d+(?:\.\d+)?)'
-            ]
-            
-            for pattern in rotation_patterns:
-                matches = re.search(pattern, stderr_text, re.IGNORECASE)
-                if matches:
-                    try:
-                        rotation = float(matches.group(1))
-                        return FFprobeExtractor.normalize_rotation(rotation)
-                    except (ValueError, TypeError):
-                        pass
+            # 复用完整探测的结果（rotate标签与Display Matrix都在其中），不单独启动ffprobe；
+            # 结构化字段都没有时即视为未旋转，不再解析ffmpeg的文本输出
+            _, video_stream = FFprobeExtractor._probe_full(file_path)
+            if video_stream:
+                rotation = FFprobeExtractor._parse_rotation(video_stream)
+                if rotation is not None:
+                    return rotation
             
             return 0  # 默认返回0表示没有旋转
         except Exception as e:
@@ -321,7 +320,7 @@ class FFprobeExtractor:
             "-of", "json"
         ]
         
-        data = FFprobeExtractor._execute_ffprobe(audio_path, args, timeout=15)
+        data = FFprobeExtractor._execute_ffprobe_cached(audio_path, args, timeout=15)
         if not data:
             return 0.0
         
@@ -337,6 +336,62 @@ class FFprobeExtractor:
         logger.warning("⚠️ 未能从ffprobe获取音频时长")
         return 0.0
     
+    @staticmethod
+    def get_h264_parameters(file_path: str) -> Optional[Tuple[str, int, str]]:
+        """
+        获取H.264视频流的(profile, level, extradata校验值)
+        
+        concat流复制合并时输出文件只保留第一个素材的SPS/PPS，只有三者全部相同的素材才能直接合并。
+        非H.264或信息不全（如旧版ffprobe不输出extradata_hash）时返回None。
+        """
+        _, video_stream = FFprobeExtractor._probe_full(file_path)
+        if not video_stream or video_stream.get("codec_name") != "h264":
+            return None
+        
+        profile = video_stream.get("profile")
+        level = video_stream.get("level")
+        extradata_hash = video_stream.get("extradata_hash")
+        if not profile or level is None or not extradata_hash:
+            return None
+        
+        return profile, int(level), extradata_hash
+    
+    @staticmethod
+    def get_keyframe_times(file_path: str) -> List[float]:
+        """
+        获取视频流所有关键帧的时间点
+        
+        使用-skip_frame nokey只解码关键帧，比逐帧探测快得多。
+        
+        Args:
+            file_path: 视频文件路径
+            
+        Returns:
+            升序排列的关键帧时间（秒），获取失败返回空列表
+        """
+        args = [
+            "-v", "error",
+            "-select_streams", "v:0",
+            "-skip_frame", "nokey",
+            "-show_entries", "frame=pts_time",
+            "-of", "json"
+        ]
+        
+        data = FFprobeExtractor._execute_ffprobe_cached(file_path, args, timeout=60)
+        if not data:
+            return []
+        
+        keyframe_times = []
+        for frame in data.get("frames", []):
+            try:
+                keyframe_times.append(float(frame["pts_time"]))
+            except (KeyError, ValueError, TypeError):
+                continue
+        
+        keyframe_times.sort()
+        logger.info(f"🔑 关键帧数量: {len(keyframe_times)} | {os.path.basename(file_path)}")
+        return keyframe_times
+    
     @staticmethod
     def get_video_framerate(video_path: str) -> float:
         """获取视频帧率"""
@@ -350,3 +405,16 @@ class FFprobeExtractor:
         
         logger.info(f"📊 视频帧率: {framerate:.2f}fps")
         return framerate
+
+
+class _ProbeError(Exception):
+    """ffprobe执行失败，用于避免失败结果进入缓存"""
+
+
+@functools.lru_cache(maxsize=4096)
+def _probe_cached(abs_path: str, mtime_ns: int, size: int, args: tuple, timeout: int) -> Dict:
+    """按文件身份缓存ffprobe结果，mtime_ns和size参与缓存键，文件被改写后自然失效"""
+    data = FFprobeExtractor._execute_ffprobe(abs_path, list(args), timeout=timeout)
+    if data is None:
+        raise _ProbeError(abs_path)
+    return data
@@ -5,10 +5,10 @@ from urllib.parse import urlencode
 
 import requests
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
 from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode
+from app.services.video_metadata import VideoMetadataExtractor
 from app.utils import utils
 
 requested_count = 0
@@ -179,12 +179,12 @@ def save_video(video_url: str, save_dir: str = "") -> str:
 
     if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
         try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
+            # validate with the cached ffprobe metadata instead of opening a MoviePy reader;
+            # the result is reused later when the clip is combined
+            metadata = VideoMetadataExtractor.get_video_metadata(video_path)
+            if metadata.duration > 0 and metadata.width > 0 and metadata.height > 0:
                 return video_path
+            raise ValueError("no playable video stream")
         except Exception as e:
             try:
                 os.remove(video_path)
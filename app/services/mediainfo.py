@@ -1,10 +1,37 @@
 import os
-import json
+import functools
 import subprocess
 import shutil
 from loguru import logger
 from typing import Dict, Any, Optional
 
+try:
+    import orjson
+except ImportError:  # 未安装orjson时退回标准库，json.loads同样接受bytes
+    import json as orjson
+
+# 模块加载时解析一次mediainfo路径，未安装时后续调用不再重复查找
+_MEDIAINFO = shutil.which("mediainfo")
+
+
+@functools.lru_cache(maxsize=1)
+def _mediainfo_usable() -> bool:
+    """检测mediainfo能否正常运行，结果在进程内只计算一次"""
+    if not _MEDIAINFO:
+        return False
+    try:
+        # 只关心返回码，输出直接丢弃
+        test_result = subprocess.run(
+            [_MEDIAINFO, "--Version"], 
+            stdout=subprocess.DEVNULL, 
+            stderr=subprocess.DEVNULL, 
+            timeout=2
+        )
+        return test_result.returncode == 0
+    except Exception as e:
+        logger.warning(f"⚠️ 检查mediainfo可用性时出错: {str(e)}")
+        return False
+
 
 class MediaInfoExtractor:
     """使用MediaInfo工具提取视频元数据的实现类"""
@@ -12,16 +39,7 @@ class MediaInfoExtractor:
     @staticmethod
     def is_available() -> bool:
         """检查系统中是否安装了mediainfo工具"""
-        try:
-            result = shutil.which("mediainfo")
-            if result:
-                test_cmd = ["mediainfo", "--Version"]
-                test_result = subprocess.run(test_cmd, capture_output=True, timeout=2)
-                return test_result.returncode == 0
-            return False
-        except Exception as e:
-            logger.warning(f"⚠️ 检查mediainfo可用性时出错: {str(e)}")
-            return False
+        return _mediainfo_usable()
     
     @staticmethod
     def normalize_rotation(rotation: float) -> int:
@@ -44,24 +62,27 @@ class MediaInfoExtractor:
                 logger.error(f"❌ 文件不存在: {file_path}")
                 return None
             
-            mediainfo_cmd = ["mediainfo", "--Output=JSON", file_path]
+            if not _MEDIAINFO:
+                logger.error("❌ 未找到mediainfo工具")
+                return None
+            
+            mediainfo_cmd = [_MEDIAINFO, "--Output=JSON", file_path]
             logger.debug(f"🔍 执行命令: {' '.join(mediainfo_cmd)}")
             
+            # 保持stdout为bytes，直接交给JSON解析器，省去解码产生的中间字符串
             result = subprocess.run(
                 mediainfo_cmd, 
                 capture_output=True, 
-                encoding='utf-8', 
-                errors='replace',
                 timeout=timeout
             )
             
             if result.returncode != 0:
-                logger.error(f"❌ mediainfo执行失败: {result.stderr}")
+                logger.error(f"❌ mediainfo执行失败: {result.stderr.decode('utf-8', errors='replace')}")
                 return None
             
             try:
-                return json.loads(result.stdout)
-            except json.JSONDecodeError as e:
+                return orjson.loads(result.stdout)
+            except ValueError as e:
                 logger.error(f"❌ 解析mediainfo JSON输出失败: {str(e)}")
                 return None
         except Exception as e:
@@ -193,6 +214,7 @@ class MediaInfoExtractor:
             "bit_depth": 0,
             "color_space": "",
             "pixel_format": "",
+            "color_range": "",
             "audio_codec": "unknown",
             "audio_channels": 0,
             "audio_sample_rate": 0,
@@ -220,6 +242,8 @@ class MediaInfoExtractor:
                 # 提取色彩信息
                 detailed_metadata["color_space"] = track.get("ColorSpace", "")
                 detailed_metadata["pixel_format"] = track.get("ChromaSubsampling", "")
+                # mediainfo只给出色度采样，色彩范围（Limited/Full）单独记录
+                detailed_metadata["color_range"] = track.get("colour_range", "")
                 
                 # 提取位深度
                 if "BitDepth" in track:
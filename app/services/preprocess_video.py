@@ -1,8 +1,10 @@
 import os
-import json
+import collections
 import subprocess
 import re
+import threading
 from typing import List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 
 from app.models import const
@@ -208,11 +210,6 @@ class VideoPreprocessor:
         Returns:
             处理后的素材列表
         """
-        # 计数器
-        processed_count = 0
-        failed_count = 0
-        skipped_count = 0
-        
         # 获取编码器
         encoder = self._get_optimal_encoder()
         logger.info(f"视频处理使用编码器: {encoder}")
@@ -220,41 +217,25 @@ class VideoPreprocessor:
         # 初始化视频元数据提取器
         self.video_metadata_extractor = VideoMetadataExtractor()
         
-        for idx, material in enumerate(materials):
-            try:
-                # 跳过无效材料
-                if not self._is_valid_material(material):
-                    logger.warning(f"跳过无效素材: {getattr(material, 'url', '<无URL>')}")
-                    skipped_count += 1
-                    continue
-                
-                logger.info(f"处理素材 [{idx+1}/{len(materials)}]: {os.path.basename(material.url)}")
-                
-                # 根据文件类型处理
-                ext = utils.parse_extension(material.url)
-                
-                if ext in const.FILE_TYPE_VIDEOS:
-                    # 处理视频
-                    success = self._process_video_file(material, encoder, clip_duration, video_aspect)
-                    if success:
-                        processed_count += 1
-                    else:
-                        failed_count += 1
-                elif ext in const.FILE_TYPE_IMAGES:
-                    # 处理图片转视频
-                    success = self._process_image_file(material, clip_duration)
-                    if success:
-                        processed_count += 1
-                    else:
-                        failed_count += 1
-                else:
-                    logger.warning(f"不支持的文件类型: {ext}")
-                    skipped_count += 1
-            except Exception as e:
-                logger.error(f"处理素材出错: {str(e)}")
-                import traceback
-                logger.debug(f"错误详情: {traceback.format_exc()}")
-                failed_count += 1
+        # 各素材互相独立，并行处理；硬件编码器的并发会话数有限，需要限制并发数
+        if encoder == "libx264":
+            max_workers = max(1, (os.cpu_count() or 2) // 2)
+        else:
+            max_workers = 3
+        max_workers = max(1, min(max_workers, len(materials)))
+        logger.info(f"并行处理 {len(materials)} 个素材，并发数: {max_workers}")
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            statuses = list(executor.map(
+                lambda item: self._process_one_material(
+                    item[0], len(materials), item[1], encoder, clip_duration, video_aspect
+                ),
+                enumerate(materials)
+            ))
+        
+        processed_count = statuses.count("processed")
+        failed_count = statuses.count("failed")
+        skipped_count = statuses.count("skipped")
         
         # 处理结果统计
         logger.info(f"视频处理完成: 总计{len(materials)}个, 成功{processed_count}个, "
@@ -262,6 +243,41 @@ class VideoPreprocessor:
         
         return materials
     
+    def _process_one_material(self, idx, total, material, encoder, clip_duration, video_aspect: VideoAspect = VideoAspect.portrait):
+        """
+        处理单个素材（在线程池中执行）
+        
+        Returns:
+            处理状态：processed、failed或skipped
+        """
+        try:
+            # 跳过无效材料
+            if not self._is_valid_material(material):
+                logger.warning(f"跳过无效素材: {getattr(material, 'url', '<无URL>')}")
+                return "skipped"
+            
+            logger.info(f"处理素材 [{idx+1}/{total}]: {os.path.basename(material.url)}")
+            
+            # 根据文件类型处理
+            ext = utils.parse_extension(material.url)
+            
+            if ext in const.FILE_TYPE_VIDEOS:
+                # 处理视频
+                success = self._process_video_file(material, encoder, clip_duration, video_aspect)
+            elif ext in const.FILE_TYPE_IMAGES:
+                # 处理图片转视频
+                success = self._process_image_file(material, clip_duration)
+            else:
+                logger.warning(f"不支持的文件类型: {ext}")
+                return "skipped"
+            
+            return "processed" if success else "failed"
+        except Exception as e:
+            logger.error(f"处理素材出错: {str(e)}")
+            import traceback
+            logger.debug(f"错误详情: {traceback.format_exc()}")
+            return "failed"
+    
     def _process_video_file(self, material, encoder, clip_duration, video_aspect: VideoAspect = VideoAspect.portrait):
         """处理单个视频文件"""
         try:
@@ -329,23 +345,28 @@ class VideoPreprocessor:
                 "ffmpeg", "-y",
                 "-loop", "1",  # 循环输入
                 "-i", material.url,
-                "-vf", f"zoompan=z='min(zoom+0.0015,1.2)':d={int(clip_duration*30)}:fps=30:x='(iw-iw/zoom)/2':y='(ih-ih/zoom)/2',scale=1080:1920:force_original_aspect_ratio=1,crop=1080:1920,format=yuv420p",
+                # 15fps已足够表现缓慢的缩放效果，帧数减半；每帧缩放步长加倍保持相同的缩放速度
+                "-vf", f"zoompan=z='min(zoom+0.003,1.2)':d={int(clip_duration*15)}:fps=15:x='(iw-iw/zoom)/2':y='(ih-ih/zoom)/2',scale=1080:1920:force_original_aspect_ratio=1,crop=1080:1920,format=yuv420p",
+                "-r", "15",
                 "-c:v", "libx264",
+                "-preset", "veryfast",
+                "-tune", "stillimage",
                 "-t", str(clip_duration),
                 "-pix_fmt", "yuv420p",
                 video_file
             ]
             
             # 执行命令
-            result = subprocess.run(
-                image_cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                encoding='utf-8',
-                errors='replace',
-                check=False
-            )
+            with HardwareAccelerator.encode_slot():
+                result = subprocess.run(
+                    image_cmd, 
+                    stdout=subprocess.PIPE, 
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                    encoding='utf-8',
+                    errors='replace',
+                    check=False
+                )
             
             if result.returncode != 0:
                 stderr_lines = result.stderr.splitlines()
@@ -466,6 +487,16 @@ class VideoPreprocessor:
                 config["needs_padding"] = True
                 logger.info(f"需要填充处理：原始比例 {source_ratio:.2f}，目标比例 {target_ratio:.2f}")
         
+        # 无需旋转、分辨率不超过1920的H.264素材，仅为缩放不值得整段重新编码：
+        # 合并时只截取其中几秒，缩放与填充在截取片段时一并完成，不再生成整段的中间文件；
+        # 其他编码（HEVC、VP9、ProRes等）仍先整段转为H.264
+        if (config["needs_processing"]
+                and not config["needs_rotation"]
+                and not config["needs_encoding"]
+                and max(width, height) <= 1920):
+            config["needs_processing"] = False
+            logger.info(f"素材无需整段预处理，留到截取片段时处理: {os.path.basename(file_path)}")
+        
         # 4. 特殊处理4K视频
         if config["is_4k"]:
             config["bitrate_boost"] *= 1.5  # 4K内容额外提升50%码率
@@ -488,16 +519,8 @@ class VideoPreprocessor:
         # 判断是否使用GPU编码器
         is_gpu_encoder = "nvenc" in encoder or "qsv" in encoder or "amf" in encoder
         
-        # 如果是GPU编码，强制执行GPU诊断
-        if is_gpu_encoder and "nvenc" in encoder:
-            logger.info("使用NVENC编码，进行GPU兼容性检查...")
-            diagnostic = HardwareAccelerator.diagnose_gpu_issues()
-            
-            # 如果诊断显示NVENC不可用，立即切换到CPU编码
-            if not diagnostic["nvenc_functional"]:
-                logger.warning("NVENC功能测试失败，切换到CPU编码")
-                encoder = "libx264"
-                is_gpu_encoder = False
+        # 编码器由get_optimal_encoder选出，NVENC已通过实际测试编码，这里不再逐个素材重复做GPU诊断；
+        # 个别素材编码失败时下面仍会回退到CPU编码
         
         # 获取硬件加速参数，对于GPU编码器使用特别简化的参数
         input_params = []
@@ -655,8 +678,9 @@ class VideoPreprocessor:
             
             filters.append(scale_filter)
         
-        # 4. 确保输出为yuv420p格式(兼容性更好)
-        filters.append("format=yuv420p")
+        # 4. 确保输出为yuv420p格式(兼容性更好)，源已是8位yuv420p时跳过转换
+        if VideoMetadataExtractor.needs_pixel_format_conversion(video_info):
+            filters.append("format=yuv420p")
         
         # 组合所有滤镜
         filter_string = ",".join(filters) if filters else "null"
@@ -728,6 +752,9 @@ class VideoPreprocessor:
             # 对于CPU编码，使用libx264的profile设置
             cmd.extend(["-profile:v", "high", "-level", "4.1"])
         
+        # 文件元数据前置，后续截取片段时无需先定位文件末尾的moov
+        cmd.extend(["-movflags", "+faststart"])
+        
         # 添加输出文件
         cmd.append(output_path)
         
@@ -747,67 +774,70 @@ class VideoPreprocessor:
             logger.info(f"使用编码器 {encoder} 执行命令")
             logger.debug(f"完整命令: {' '.join(cmd)}")
             
-            process = subprocess.Popen(
-                cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE, 
-                universal_newlines=True,
-                encoding='utf-8',
-                errors='replace'
-            )
-            
-            # 收集完整错误输出
-            stderr_output = []
-            progress_shown = False
-            
-            # 实时显示处理进度
-            for line in process.stderr:
-                stderr_output.append(line)
+            # 进度通过-progress pipe:1以key=value形式写到stdout，-nostats关闭stderr中逐帧刷新的统计行，
+            # stderr只剩警告和错误，在单独的线程中收集末尾部分，结束后再统一分析
+            cmd = [cmd[0], "-progress", "pipe:1", "-nostats"] + cmd[1:]
+            
+            # 占用全局编码并发名额，与其他任务的ffmpeg编码共同受限
+            with HardwareAccelerator.encode_slot(encoder):
+                process = subprocess.Popen(
+                    cmd, 
+                    stdout=subprocess.PIPE, 
+                    stderr=subprocess.PIPE, 
+                    universal_newlines=True,
+                    encoding='utf-8',
+                    errors='replace'
+                )
+            
+                stderr_output = collections.deque(maxlen=200)
+                
+                def drain_stderr():
+                    for line in process.stderr:
+                        stderr_output.append(line)
                 
-                # 显示进度
-                if "time=" in line and "bitrate=" in line:
+                stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+                stderr_thread.start()
+                
+                # 显示处理进度
+                progress_shown = False
+                for line in process.stdout:
+                    key, _, value = line.partition("=")
+                    if key != "out_time":
+                        continue
                     if not progress_shown:
-                        logger.info(f"处理进度: {line.strip()}")
+                        logger.info(f"处理进度: {value.strip()}")
                         progress_shown = True
                     else:
-                        logger.debug(f"进度: {line.strip()}")
-                
-                # 处理警告和错误，但不显示为错误日志
-                # 将某些常见错误处理为调试信息而不是警告
-                if "Error" in line or "Invalid" in line or "failed" in line:
-                    # 这些是预期的编码器错误，记录为调试信息而不是警告
-                    if "nvenc" in encoder and ("Invalid Level" in line or "InitializeEncoder failed" in line):
-                        logger.debug(f"编码器预期消息: {line.strip()}")
-                    else:
-                        logger.debug(f"处理中消息: {line.strip()}")
+                        logger.debug(f"进度: {value.strip()}")
             
-            process.wait()
+                stderr_thread.join()
+                process.wait()
             
-            if process.returncode != 0:
-                # 对于NVENC的特定错误，降级但不报告错误
-                if "nvenc" in encoder and any("Invalid Level" in line for line in stderr_output):
-                    logger.info(f"编码器参数不兼容，将自动切换到替代编码器")
-                    return False
+                if process.returncode != 0:
+                    # 对于NVENC的特定错误，降级但不报告错误
+                    if "nvenc" in encoder and any("Invalid Level" in line for line in stderr_output):
+                        logger.info(f"编码器参数不兼容，将自动切换到替代编码器")
+                        return False
                 
-                logger.info(f"命令返回非零代码: {process.returncode}，尝试替代方法")
-                error_shown = False
+                    logger.info(f"命令返回非零代码: {process.returncode}，尝试替代方法")
+                    error_shown = False
                 
-                # 将错误记录到调试日志而不是错误日志
-                for line in stderr_output:
-                    if "Error" in line or "Invalid" in line or "failed" in line or "No such filter" in line:
-                        logger.debug(line.strip())
-                        error_shown = True
+                    # 将错误记录到调试日志而不是错误日志
+                    for line in stderr_output:
+                        if "Error" in line or "Invalid" in line or "failed" in line or "No such filter" in line:
+                            logger.debug(line.strip())
+                            error_shown = True
                 
-                # 如果没有找到特定错误，显示最后几行
-                if not error_shown and stderr_output:
-                    logger.debug("最后几行输出:")
-                    for line in stderr_output[-5:]:
-                        logger.debug(line.strip())
+                    # 如果没有找到特定错误，显示最后几行
+                    if not error_shown and stderr_output:
+                        logger.debug("最后几行输出:")
+                        for line in list(stderr_output)[-5:]:
+                            logger.debug(line.strip())
                     
-                return False
+                    return False
             
-            logger.info(f"命令执行成功，使用编码器: {encoder}")
-            return True
+                logger.info(f"命令执行成功，使用编码器: {encoder}")
+                return True
             
         except Exception as e:
             logger.info(f"执行命令时遇到问题，将尝试替代方法: {str(e)}")
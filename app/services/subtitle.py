@@ -13,6 +13,8 @@ model_size = config.whisper.get("model_size", "large-v3")
 device = config.whisper.get("device", "cpu")
 compute_type = config.whisper.get("compute_type", "int8")
 model = None
+# SRT时间轴行，解析时逐行匹配
+_SRT_TIME_RE = re.compile("([0-9]*:[0-9]*:[0-9]*,[0-9]*)")
 
 
 def create(audio_file, subtitle_file: str = ""):
@@ -146,7 +148,7 @@ def file_to_subtitles(filename):
     index = 0
     with open(filename, "r", encoding="utf-8") as f:
         for line in f:
-            times = re.findall("([0-9]*:[0-9]*:[0-9]*,[0-9]*)", line)
+            times = _SRT_TIME_RE.findall(line)
             if times:
                 current_times = line
             elif line.strip() == "" and current_times:
@@ -270,9 +272,12 @@ def correct(subtitle_file, video_script):
         corrected = True
 
     if corrected:
+        payload = "".join(
+            f"{i + 1}\n{item[1]}\n{item[2]}\n\n"
+            for i, item in enumerate(new_subtitle_items)
+        )
         with open(subtitle_file, "w", encoding="utf-8") as fd:
-            for i, item in enumerate(new_subtitle_items):
-                fd.write(f"{i + 1}\n{item[1]}\n{item[2]}\n\n")
+            fd.write(payload)
         logger.info("Subtitle corrected")
     else:
         logger.success("Subtitle is correct")
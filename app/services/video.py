@@ -17,23 +17,30 @@
    - 通过元数据缓存和文件名标记识别预处理过的视频
 """
 
+import bisect
+import collections
+import functools
 import glob
+import itertools
 import os
 import random
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import time
 import re
-import json
 import subprocess
 import shutil
+import struct
 import uuid
 import math
-import shlex  # 添加shlex模块导入
 import sys
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from loguru import logger
 from PIL import ImageFont
 
+from app.config import config
 from app.models import const
 from app.models.schema import (
     MaterialInfo,
@@ -44,8 +51,13 @@ from app.models.schema import (
 )
 from app.utils import utils
 
+from app.services.ffprobe import FFprobeExtractor
 from app.services.video_metadata import VideoMetadataExtractor
 from app.services.preprocess_video import VideoPreprocessor
+from app.services.video_encoder import EncoderConfig, HardwareAccelerator
+
+# 所有片段统一的固定帧率：重新编码的片段直接输出该帧率，流复制的素材也必须已是该帧率
+_SEGMENT_FPS = 60
 
  
 # 预处理视频 给外部调用
@@ -57,6 +69,22 @@ def preprocess_video(materials: List[MaterialInfo], clip_duration=4, video_aspec
     return VideoPreprocessor.preprocess_video(materials, clip_duration, video_aspect)
 
 
+@functools.lru_cache(maxsize=8)
+def _scan_bgm_files(song_dir: str, mtime_ns: int) -> Tuple[str, ...]:
+    """扫描背景音乐目录，目录修改时间参与缓存键，目录内容变化后自然重新扫描"""
+    return tuple(glob.glob(os.path.join(song_dir, "*.mp3")))
+
+
+def _list_bgm_files(song_dir: str) -> Tuple[str, ...]:
+    """列出背景音乐目录中的mp3文件，按目录修改时间缓存（lru_cache线程安全，可供并发任务共用）"""
+    try:
+        mtime = os.stat(song_dir).st_mtime_ns
+    except OSError:
+        return ()
+    
+    return _scan_bgm_files(song_dir, mtime)
+
+
 def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     if not bgm_type:
         return ""
@@ -65,14 +93,474 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
         return bgm_file
 
     if bgm_type == "random":
-        suffix = "*.mp3"
-        song_dir = utils.song_dir()
-        files = glob.glob(os.path.join(song_dir, suffix))
+        files = _list_bgm_files(utils.song_dir())
+        if not files:
+            return ""
         return random.choice(files)
 
     return ""
 
 
+def _escape_filter_value(value: str) -> str:
+    """
+    按ffmpeg滤镜的两级转义规则转义一个选项值
+    
+    先转义选项值中的 \\ ' :（如Windows盘符后的冒号），再转义滤镜图中的 \\ ' [ ] , ;。
+    命令以参数列表传给ffmpeg，不经过shell，不能使用shell的引号规则。
+    """
+    for char in "\\':":
+        value = value.replace(char, "\\" + char)
+    for char in "\\'[],;":
+        value = value.replace(char, "\\" + char)
+    return value
+
+
+def _escape_filter_path(path: str) -> str:
+    """
+    将文件路径转换为可以直接写进滤镜参数的形式
+    
+    统一使用绝对路径；Windows下改用正斜杠，其他系统的反斜杠是文件名的一部分，原样转义。
+    """
+    safe_path = os.path.abspath(path)
+    if os.name == "nt":
+        safe_path = safe_path.replace("\\", "/")
+    return _escape_filter_value(safe_path)
+
+
+def _build_subtitle_filter(subtitle_path: str, params: VideoParams) -> str:
+    """
+    根据视频参数生成subtitles滤镜，路径转义和样式拼接只在这里做一次
+    
+    Args:
+        subtitle_path: SRT字幕文件路径
+        params: 视频参数，使用其中的字体、字号、颜色、描边和字幕位置
+        
+    Returns:
+        完整的subtitles滤镜字符串
+    """
+    # 确保字体名称安全
+    safe_font_name = params.font_name.replace(",", "\\,").replace(":", "\\:")
+    
+    # 确定字幕位置
+    alignment = 2  # 默认底部居中
+    if params.subtitle_position == "top":
+        alignment = 8  # 顶部居中
+    elif params.subtitle_position == "center":
+        alignment = 5  # 中间居中
+    
+    # 垂直边距
+    vertical_margin = 50
+    
+    force_style = ",".join([
+        f"FontName={safe_font_name}",
+        f"FontSize={params.font_size}",
+        f"PrimaryColour=&H{params.text_fore_color[1:]}&",
+        f"OutlineColour=&H{params.stroke_color[1:]}&",
+        "BorderStyle=1",
+        f"Outline={params.stroke_width}",
+        f"Alignment={alignment}",
+        f"MarginV={vertical_margin}",
+    ])
+    return f"subtitles={_escape_filter_path(subtitle_path)}:force_style='{force_style}'"
+
+
+def _run_ffmpeg_bounded(cmd: List[str], input: Optional[bytes] = None, tail_bytes: int = 65536) -> Tuple[int, str]:
+    """
+    执行ffmpeg命令，只保留stderr末尾的一段用于报错
+    
+    capture_output会把长时间编码的全部stderr缓存在内存中，这里改为在线程中按块读取，
+    超出tail_bytes的部分直接丢弃，内存占用与编码时长无关。
+    
+    Args:
+        cmd: ffmpeg命令
+        input: 写入stdin的数据（如concat列表），为None时不连接stdin
+        tail_bytes: 保留的stderr末尾字节数
+        
+    Returns:
+        (返回码, stderr末尾文本)
+    """
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    stderr_tail = bytearray()
+    
+    def drain_stderr():
+        fd = process.stderr.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            stderr_tail.extend(chunk)
+            if len(stderr_tail) > tail_bytes:
+                del stderr_tail[:-tail_bytes]
+    
+    stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+    stderr_thread.start()
+    
+    if input is not None:
+        try:
+            process.stdin.write(input)
+        except BrokenPipeError:
+            # ffmpeg提前退出，错误信息见stderr
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+    
+    process.wait()
+    stderr_thread.join()
+    process.stderr.close()
+    return process.returncode, stderr_tail.decode("utf-8", errors="replace")
+
+
+def _is_nonempty_file(path: str) -> bool:
+    """检查文件是否存在且非空（单次stat调用）"""
+    try:
+        return os.stat(path).st_size > 0
+    except OSError:
+        return False
+
+
+def _is_valid_mp4(path: str) -> bool:
+    """
+    遍历MP4顶层盒检查文件是否完整写出，代替额外的ffprobe验证
+    
+    第一个盒必须是ftyp，且必须包含moov盒；任何盒的长度超出文件末尾都说明文件被截断。
+    不设最小文件大小，时长很短的有效文件同样可以通过。
+    
+    Args:
+        path: 文件路径
+        
+    Returns:
+        文件结构完整时返回True
+    """
+    try:
+        file_size = os.path.getsize(path)
+        has_moov = False
+        offset = 0
+        with open(path, "rb") as f:
+            while offset < file_size:
+                f.seek(offset)
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                # ISO/IEC 14496-12: 盒头为4字节长度+4字节类型，长度为1时后跟8字节扩展长度，为0时延伸到文件末尾
+                box_size, box_type = struct.unpack(">I4s", header)
+                header_size = 8
+                if box_size == 1:
+                    large_size = f.read(8)
+                    if len(large_size) < 8:
+                        return False
+                    box_size = struct.unpack(">Q", large_size)[0]
+                    header_size = 16
+                elif box_size == 0:
+                    box_size = file_size - offset
+                
+                if box_size < header_size or offset + box_size > file_size:
+                    return False
+                if offset == 0 and box_type != b"ftyp":
+                    return False
+                if box_type == b"moov":
+                    has_moov = True
+                offset += box_size
+    except OSError:
+        return False
+    
+    return has_moov
+
+
+def _build_segment(job: dict, threads: int = 2) -> Optional[str]:
+    """
+    截取并编码单个视频片段
+    
+    Args:
+        job: 片段任务，包含video_path、segment_path、start_time、segment_duration、
+             needs_pix_fmt、vf、cuda_vf、fallback_vf、encoder、hw_decode
+        threads: 单个ffmpeg进程使用的编码线程数
+        
+    Returns:
+        成功时返回片段路径，失败返回None
+    """
+    video_path = job["video_path"]
+    segment_path = job["segment_path"]
+    start_time = job["start_time"]
+    segment_duration = job["segment_duration"]
+    needs_pix_fmt = job["needs_pix_fmt"]
+    
+    try:
+        # 构造截取片段命令：-ss和-t都放在-i之前，由解复用器直接跳转到起点附近的关键帧，
+        # 不解码起点之前的内容；ffmpeg 2.1起输入端-ss在转码时仍是帧精确的
+        encoder = job.get("encoder", "libx264")
+        segment_cmd = ["ffmpeg", "-y"]
+        # NVENC且素材有显存内缩放滤镜时，解码和缩放都在显存中完成，只把缩小后的帧下载回内存做填充
+        vf = job["vf"]
+        use_cuda_filters = encoder == "h264_nvenc" and bool(job.get("cuda_vf"))
+        if use_cuda_filters:
+            vf = job["cuda_vf"]
+            segment_cmd.extend(["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"])
+        elif encoder != "libx264" or job.get("hw_decode"):
+            # GPU编码或HEVC素材时尝试硬件解码，解码后的帧仍回到内存中，滤镜照常可用；
+            # 不可用时-hwaccel auto自动退回软件解码
+            segment_cmd.extend(["-hwaccel", "auto"])
+        segment_cmd.extend([
+            "-ss", str(start_time),
+            "-t", str(segment_duration),
+            "-i", video_path,
+        ])
+        
+        # 滤镜串在规划阶段已按素材生成好
+        if vf:
+            segment_cmd.extend(["-vf", vf])
+        
+        # 添加输出参数
+        segment_cmd.append("-an")
+        segment_cmd.extend(EncoderConfig.get_segment_encoder_args(encoder))
+        segment_cmd.extend([
+            "-threads", str(threads),
+            "-r", str(_SEGMENT_FPS),  # 截取时直接统一为固定帧率，无需再单独标准化
+            "-vsync", "cfr",
+            # 固定GOP和时间基，各片段参数一致，合并时可直接流复制
+            "-g", "48",
+            "-keyint_min", "48",
+            "-sc_threshold", "0",
+            "-video_track_timescale", "90000",
+        ])
+        if needs_pix_fmt:
+            segment_cmd.extend(["-pix_fmt", "yuv420p"])
+        segment_cmd.append(segment_path)
+        
+        logger.info(f"片段处理命令: {' '.join(segment_cmd)}")
+        
+        # 执行命令
+        with HardwareAccelerator.encode_slot(encoder):
+            returncode, error_msg = _run_ffmpeg_bounded(segment_cmd)
+        if returncode != 0 and use_cuda_filters:
+            # 驱动或ffmpeg不支持CUDA滤镜时，改回内存中的滤镜串，仍使用NVENC编码
+            logger.warning(f"CUDA滤镜处理视频片段失败，改用常规滤镜: {error_msg}")
+            return _build_segment({**job, "cuda_vf": ""}, threads)
+        if returncode != 0:
+            logger.error(f"处理视频片段失败: {error_msg}")
+            
+            # 尝试使用备用简化命令
+            if "Invalid too big or non positive size" in error_msg or "Error initializing filter" in error_msg:
+                logger.warning("使用备用简化命令处理视频片段")
+                backup_cmd = [
+                    "ffmpeg", "-y",
+                    "-ss", str(start_time),
+                    "-t", str(segment_duration),
+                    "-i", video_path,
+                    "-vf", job["fallback_vf"],
+                    "-an",
+                    "-c:v", "libx264",
+                    "-preset", "ultrafast", # 使用更快的预设
+                    "-crf", "28", # 降低质量要求确保成功
+                    "-r", str(_SEGMENT_FPS),
+                    "-vsync", "cfr",
+                    "-g", "48",
+                    "-keyint_min", "48",
+                    "-sc_threshold", "0",
+                    "-video_track_timescale", "90000",
+                    segment_path
+                ]
+                
+                with HardwareAccelerator.encode_slot():
+                    returncode, backup_error = _run_ffmpeg_bounded(backup_cmd)
+                if returncode != 0:
+                    logger.error(f"备用命令也失败: {backup_error}")
+                    return None
+        
+        if _is_valid_mp4(segment_path):
+            logger.info(f"创建视频片段: {segment_path}, 时长: {segment_duration:.2f}秒")
+            return segment_path
+        
+        logger.error(f"创建视频片段失败: {segment_path}")
+        return None
+    except Exception as e:
+        logger.error(f"处理视频片段失败: {str(e)}")
+        return None
+
+
+def _encode_audio_track(audio_file: str, output_path: str) -> Optional[str]:
+    """
+    将配音编码为AAC音轨，供最终合成时直接流复制
+    
+    Returns:
+        编码后的音频路径，失败返回None（调用方回退到合成时编码）
+    """
+    cmd = [
+        "ffmpeg", "-y",
+        "-i", audio_file,
+        "-vn",
+        "-c:a", "aac",
+        "-b:a", "192k",
+        output_path
+    ]
+    returncode, error_msg = _run_ffmpeg_bounded(cmd)
+    if returncode != 0:
+        logger.warning(f"音频预编码失败，将在合成时编码: {error_msg}")
+        return None
+    
+    if _is_nonempty_file(output_path):
+        return output_path
+    return None
+
+
+def _combine_single_video(
+    video_path: str,
+    audio_file: str,
+    audio_duration: float,
+    target_width: int,
+    target_height: int,
+    scale_pad_vf: str,
+    combined_video_path: str,
+) -> Optional[str]:
+    """
+    单个素材且时长足够覆盖音频时的快速路径：一次ffmpeg完成截取和配音，跳过切片与合并。
+    
+    分辨率、编码都符合目标时直接流复制，否则只做一次缩放填充编码。
+    
+    Returns:
+        合并后的视频路径；不满足快速路径条件或处理失败时返回None，由调用方走常规流程
+    """
+    metadata = VideoMetadataExtractor.get_video_metadata(video_path)
+    if not metadata or metadata.width == 0 or metadata.height == 0:
+        return None
+    
+    if metadata.duration < audio_duration:
+        return None
+    
+    # 与多素材路径相同的条件：未旋转、尺寸和帧率符合目标的8位yuv420p H.264素材才能流复制
+    can_copy = (
+        metadata.width == target_width
+        and metadata.height == target_height
+        and metadata.codec in ("h264", "avc", "avc1")
+        and metadata.rotation == 0
+        and round(metadata.framerate or 0, 2) == _SEGMENT_FPS
+        and not VideoMetadataExtractor.needs_pixel_format_conversion(metadata)
+    )
+    
+    def build_cmd(encoder: str) -> List[str]:
+        cmd = ["ffmpeg", "-y"]
+        if encoder not in ("copy", "libx264"):
+            # 与片段编码相同：GPU编码时尝试硬件解码，不可用时自动退回软件解码
+            cmd.extend(["-hwaccel", "auto"])
+        cmd.extend([
+            "-ss", "0",
+            "-t", f"{audio_duration:.3f}",
+            "-i", video_path,
+            "-i", audio_file,
+            "-map", "0:v:0",
+            "-map", "1:a:0",
+        ])
+        if encoder == "copy":
+            cmd.extend(["-c:v", "copy"])
+        else:
+            cmd.extend(["-vf", scale_pad_vf, "-r", str(_SEGMENT_FPS)])
+            cmd.extend(EncoderConfig.get_segment_encoder_args(encoder))
+            cmd.extend(["-pix_fmt", "yuv420p"])
+        cmd.extend([
+            "-c:a", "aac",
+            "-b:a", "192k",
+            "-shortest",
+            combined_video_path
+        ])
+        return cmd
+    
+    # 编码器选择与多素材路径一致：优先使用检测到的硬件编码器，失败时改用libx264重试一次
+    encoder = "copy" if can_copy else HardwareAccelerator.get_optimal_encoder()
+    cmd = build_cmd(encoder)
+    logger.info(f"单素材快速合成({'流复制' if can_copy else f'缩放编码: {encoder}'}): {' '.join(cmd)}")
+    
+    with HardwareAccelerator.encode_slot(encoder):
+        returncode, error_msg = _run_ffmpeg_bounded(cmd)
+    if returncode != 0 and encoder not in ("copy", "libx264"):
+        logger.warning(f"硬件编码器 {encoder} 单素材合成失败，改用libx264重新编码: {error_msg}")
+        with HardwareAccelerator.encode_slot("libx264"):
+            returncode, error_msg = _run_ffmpeg_bounded(build_cmd("libx264"))
+    if returncode != 0:
+        logger.warning(f"单素材快速合成失败，回退到常规流程: {error_msg}")
+        return None
+    
+    if _is_valid_mp4(combined_video_path):
+        logger.info(f"视频合成成功: {combined_video_path}")
+        return combined_video_path
+    
+    return None
+
+
+def _select_segment_jobs(segment_jobs: List[dict], audio_duration: float,
+                         video_concat_mode: VideoConcatMode) -> List[dict]:
+    """
+    确定实际需要编码的片段：随机模式先打乱顺序，再按累计时长截断
+    
+    超出音频时长的片段最终会被-shortest裁掉，无需编码；覆盖音频所需的片段之外，
+    另多保留一个片段作为编码失败时的余量。
+    """
+    if video_concat_mode == VideoConcatMode.random:
+        segment_jobs = list(segment_jobs)
+        random.shuffle(segment_jobs)
+    cumulative_durations = list(itertools.accumulate(job["segment_duration"] for job in segment_jobs))
+    needed_count = bisect.bisect_left(cumulative_durations, audio_duration) + 2
+    if needed_count < len(segment_jobs):
+        logger.info(f"已规划 {len(segment_jobs)} 个片段，覆盖音频时长只需 {needed_count} 个")
+        return segment_jobs[:needed_count]
+    return segment_jobs
+
+
+def _jobs_allow_stream_copy(segment_jobs: List[dict]) -> bool:
+    """
+    所有片段都满足流复制条件且帧率都是_SEGMENT_FPS时才整体走流复制
+    
+    重新编码的片段统一输出_SEGMENT_FPS，流复制的素材也必须已是该帧率，
+    否则15fps的图片片段或30fps的素材会原样进入成片，改变输出帧率。
+    """
+    return bool(segment_jobs) and all(
+        job["can_copy"] and job["framerate"] == _SEGMENT_FPS for job in segment_jobs
+    )
+
+
+def _h264_parameters_match(h264_parameters) -> bool:
+    """
+    判断各素材的H.264参数（profile, level, extradata校验值）是否完全相同
+    
+    合并后的MP4只保存第一个素材的SPS/PPS，任一素材参数不同或无法获取时都不能流复制合并。
+    """
+    h264_parameters = set(h264_parameters)
+    return None not in h264_parameters and len(h264_parameters) == 1
+
+
+def _pad_concat_entries(concat_entries: List[tuple], entry_durations: List[float],
+                        audio_duration: float, shuffle: bool = False) -> List[tuple]:
+    """
+    素材总时长不足以覆盖音频时，按索引循环重复已有片段补足，不复制片段文件也不重新编码
+    
+    Returns:
+        补足后的concat列表条目（新列表，不修改传入的列表）
+    """
+    concat_entries = list(concat_entries)
+    total_duration = sum(entry_durations)
+    if not 0 < total_duration < audio_duration:
+        return concat_entries
+    
+    logger.info(f"片段总时长 {total_duration:.2f} 秒不足音频时长，循环重复片段补足")
+    base_count = len(concat_entries)
+    while total_duration < audio_duration:
+        order = list(range(base_count))
+        if shuffle:
+            random.shuffle(order)
+        for i in order:
+            concat_entries.append(concat_entries[i])
+            total_duration += entry_durations[i]
+            if total_duration >= audio_duration:
+                break
+    return concat_entries
+
+
 def combine_videos(
     combined_video_path: str,
     video_paths: List[str],
@@ -103,18 +591,27 @@ def combine_videos(
         # 确保输出目录存在
         os.makedirs(os.path.dirname(combined_video_path), exist_ok=True)
         
-        # 创建临时目录
-        temp_dir = os.path.join(os.path.dirname(combined_video_path), "temp_combine_" + str(uuid.uuid4()))
-        os.makedirs(temp_dir, exist_ok=True)
+        # 一次性过滤掉不存在或为空的素材，不在遍历过程中修改列表
+        valid_video_paths = []
+        for video_path in video_paths:
+            if _is_nonempty_file(video_path):
+                valid_video_paths.append(video_path)
+            else:
+                logger.warning(f"跳过不存在或为空的视频素材: {video_path}")
+        video_paths = valid_video_paths
+        if not video_paths:
+            logger.error("没有可用的视频素材")
+            return None
         
-        # 记录需要清理的临时文件
-        processed_paths = []
-        segment_files = []
+        # 创建临时目录（包含进程号，保证并发合成时互不冲突）
+        temp_dir = os.path.join(os.path.dirname(combined_video_path), f"temp_combine_{os.getpid()}_{uuid.uuid4()}")
+        os.makedirs(temp_dir, exist_ok=True)
         
-        # 获取音频时长
-        audio_probe_cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", audio_file]
-        audio_info = json.loads(subprocess.check_output(audio_probe_cmd, universal_newlines=True))
-        audio_duration = float(audio_info["format"]["duration"])
+        # 获取音频时长（经由元数据缓存，同一音频只探测一次）
+        audio_duration = VideoMetadataExtractor.get_audio_duration(audio_file)
+        if audio_duration <= 0:
+            logger.error(f"无法获取音频时长: {audio_file}")
+            return None
         logger.info(f"音频时长: {audio_duration} 秒")
         
         # 设置视频分辨率
@@ -122,9 +619,38 @@ def combine_videos(
         target_width, target_height = aspect.to_resolution()
         logger.info(f"目标视频分辨率: {target_width}x{target_height}")
         
-        # 处理每个视频
-        processed_segments = []
+        # 目标分辨率确定后，缩放填充滤镜串只生成一次，单素材快速路径和切片流程共用
+        scale_filter = f"scale={target_width}:{target_height}:force_original_aspect_ratio=decrease"
+        pad_filter = f"pad={target_width}:{target_height}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+        scale_pad_vf = f"{scale_filter},{pad_filter}"
+        # 需要转换像素格式时format紧跟在scale之后，swscale在同一次缩放中完成转换，
+        # pad直接在yuv420p帧上进行，不会在末尾再插入一次完整的格式转换
+        scale_format_pad_vf = f"{scale_filter},format=yuv420p,{pad_filter}"
+        # NVENC编码时的等价滤镜串：scale_cuda在显存中缩放并转为nv12，pad没有CUDA实现，下载后在内存中完成
+        cuda_scale_pad_vf = (
+            f"scale_cuda={target_width}:{target_height}:force_original_aspect_ratio=decrease:format=nv12,"
+            f"hwdownload,format=nv12,{pad_filter}"
+        )
+        fallback_vf = f"scale={target_width}:{target_height},setsar=1,format=yuv420p"
+        
+        # 只有一个素材且时长足够时，直接截取并配音，无需切片合并
+        if len(video_paths) == 1:
+            result = _combine_single_video(
+                video_paths[0], audio_file, audio_duration,
+                target_width, target_height, scale_format_pad_vf, combined_video_path
+            )
+            if result:
+                return result
+        
+        # 所有素材的元数据并发预取，规划阶段直接读取缓存
+        VideoMetadataExtractor.prefetch_metadata(video_paths)
+        
+        # 处理每个视频：先探测并规划所有片段
+        segment_jobs = []
+        encoded_audio = None
         segment_index = 0
+        # HEVC解码开销大，有硬件解码能力时即使用libx264编码也交给GPU解码
+        has_hwaccel = bool(HardwareAccelerator.detect_hwaccels())
         
         for idx, video_path in enumerate(video_paths):
             try:
@@ -164,20 +690,28 @@ def combine_videos(
                 
                 logger.info(f"视频信息: 宽={width}, 高={height}, 编码={codec}, 旋转={rotation}°")
                 
-                # 获取视频时长（如果元数据中无时长，尝试获取）
+                # 元数据的时长已包含容器时长和视频流时长两种来源，无需再次探测（不做逐帧计数）；
+                # 两者都缺失时跳过该素材，避免按猜测的时长截取到文件末尾之外
                 if v_duration <= 0:
-                    try:
-                        duration_cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", video_path]
-                        duration_output = subprocess.check_output(duration_cmd, universal_newlines=True).strip()
-                        if duration_output:
-                            v_duration = float(duration_output)
-                    except Exception as e:
-                        logger.warning(f"获取视频时长失败: {str(e)}")
-                        v_duration = 10.0  # 设置一个默认值
+                    logger.warning(f"获取视频时长失败，跳过该素材: {video_path}")
+                    continue
                 
                 # 判断视频方向
                 is_portrait = effective_height > effective_width
                 
+                # 已是8位yuv420p的源无需再做像素格式转换
+                needs_pix_fmt = VideoMetadataExtractor.needs_pixel_format_conversion(metadata)
+                
+                # 未旋转、尺寸已是目标分辨率的8位yuv420p H.264素材，可以直接流复制截取；
+                # concat合并只保留第一个文件的旋转信息（Display Matrix），旧版ffmpeg截取时还可能丢失，
+                # 带旋转的素材一律走缩放编码路径，由解码时的自动旋转得到正确方向
+                can_copy = (
+                    codec.lower() in ("h264", "avc", "avc1")
+                    and rotation == 0
+                    and (width, height) == (target_width, target_height)
+                    and not needs_pix_fmt
+                )
+                
                 # 确定每个片段的时长
                 clip_duration = min(max_clip_duration, v_duration)
                 
@@ -197,266 +731,171 @@ def combine_videos(
                     else:
                         start_times = [0]
                 
+                # 每个素材只组合一次滤镜串，该素材的所有片段共用
+                # （ffmpeg解码时会按旋转元数据自动旋转，这里不再额外添加transpose）
+                clip_filters = []
+                if not is_preprocessed:
+                    # 统一分辨率，保证所有片段可以直接流复制合并；
+                    # 同时需要转换像素格式时使用合并后的滤镜串，缩放和格式转换一次完成
+                    if (effective_width, effective_height) != (target_width, target_height):
+                        clip_filters.append(scale_format_pad_vf if needs_pix_fmt else scale_pad_vf)
+                    elif needs_pix_fmt:
+                        # 添加像素格式确保兼容性
+                        clip_filters.append("format=yuv420p")
+                clip_vf = ",".join(clip_filters)
+                # 显存中的帧无法自动旋转，只有未旋转且需要缩放的素材才使用CUDA滤镜串
+                clip_cuda_vf = ""
+                if not is_preprocessed and rotation == 0 \
+                        and (effective_width, effective_height) != (target_width, target_height):
+                    clip_cuda_vf = cuda_scale_pad_vf
+                
                 for start_time in start_times:
                     segment_filename = f"segment_{segment_index:03d}.mp4"
-                    segment_path = os.path.join(temp_dir, segment_filename)
                     segment_index += 1
                     
-                    # 计算片段时长
-                    segment_duration = min(max_clip_duration, v_duration - start_time)
-                    
-                    # 构造截取片段命令
-                    segment_cmd = [
-                        "ffmpeg", "-y",
-                        "-ss", str(start_time),
-                        "-i", video_path,
-                        "-t", str(segment_duration)
-                    ]
-                    
-                    # 只有未预处理的视频才需要添加滤镜
-                    if not is_preprocessed:
-                        # 应用视频滤镜（如果需要）
-                        filters = []
-                        
-                        # 添加像素格式确保兼容性
-                        filters.append("format=yuv420p")
-                        
-                        # 组合所有滤镜
-                        if filters:
-                            vf_filter = ",".join(filters)
-                            segment_cmd.extend(["-vf", vf_filter])
-                    
-                    # 添加输出参数
-                    segment_cmd.extend([
-                        "-c:v", "libx264",
-                        "-preset", "fast",
-                        "-crf", "23",
-                        "-pix_fmt", "yuv420p",
-                        segment_path
-                    ])
-                    
-                    logger.info(f"片段处理命令: {' '.join(segment_cmd)}")
-                    
-                    # 执行命令
-                    try:
-                        subprocess.run(segment_cmd, check=True, capture_output=True)
-                    except subprocess.CalledProcessError as e:
-                        error_msg = e.stderr.decode('utf-8', errors='replace') if e.stderr else ''
-                        logger.error(f"处理视频片段失败: {error_msg}")
-                        
-                        # 尝试使用备用简化命令
-                        if "Invalid too big or non positive size" in error_msg or "Error initializing filter" in error_msg:
-                            logger.warning("使用备用简化命令处理视频片段")
-                            backup_cmd = [
-                                "ffmpeg", "-y",
-                                "-ss", str(start_time),
-                                "-i", video_path,
-                                "-t", str(segment_duration),
-                                "-vf", "format=yuv420p",
-                                "-c:v", "libx264",
-                                "-preset", "ultrafast", # 使用更快的预设
-                                "-crf", "28", # 降低质量要求确保成功
-                                segment_path
-                            ]
-                            
-                            try:
-                                subprocess.run(backup_cmd, check=True, capture_output=True)
-                            except subprocess.CalledProcessError as e2:
-                                logger.error(f"备用命令也失败: {e2.stderr.decode('utf-8', errors='replace') if e2.stderr else ''}")
-                                continue
-                    
-                    if os.path.exists(segment_path) and os.path.getsize(segment_path) > 0:
-                        segment_files.append(segment_path)
-                        logger.info(f"创建视频片段: {segment_path}, 时长: {segment_duration:.2f}秒")
-                    else:
-                        logger.error(f"创建视频片段失败: {segment_path}")
+                    # 记录片段任务，稍后并行编码
+                    segment_jobs.append({
+                        "video_path": video_path,
+                        "segment_path": os.path.join(temp_dir, segment_filename),
+                        "start_time": start_time,
+                        "segment_duration": min(max_clip_duration, v_duration - start_time),
+                        "needs_pix_fmt": needs_pix_fmt,
+                        "vf": clip_vf,
+                        "cuda_vf": clip_cuda_vf,
+                        "fallback_vf": fallback_vf,
+                        "can_copy": can_copy,
+                        "framerate": round(metadata.framerate or 0, 2),
+                        "hw_decode": has_hwaccel and codec.lower() in ("hevc", "h265"),
+                    })
             except Exception as e:
                 logger.error(f"处理视频失败: {str(e)}")
                 continue
         
-        # 如果没有有效片段，返回失败
-        if not segment_files:
-            logger.error("没有有效的视频片段")
-            return None
-            
-        # 随机打乱片段顺序（如果是随机模式）
-        if video_concat_mode == VideoConcatMode.random:
-            random.shuffle(segment_files)
+        segment_jobs = _select_segment_jobs(segment_jobs, audio_duration, video_concat_mode)
         
-        # 使用concat分离器合并视频片段
-        concat_output_path = os.path.join(temp_dir, "concat_output.mp4")
+        stream_copy = _jobs_allow_stream_copy(segment_jobs)
+        copy_paths = list(dict.fromkeys(job["video_path"] for job in segment_jobs))
+        if stream_copy:
+            # 不同来源的素材即使编码、尺寸、帧率相同，profile、level或参数集不同时
+            # 合并后的片段也会解码出错，必须全部一致才能流复制
+            with ThreadPoolExecutor(max_workers=min(8, len(copy_paths))) as executor:
+                h264_parameters = list(executor.map(VideoMetadataExtractor.get_h264_parameters, copy_paths))
+            if not _h264_parameters_match(h264_parameters):
+                logger.info("素材的H.264参数集（profile/level/SPS/PPS）不一致，改为重新编码片段")
+                stream_copy = False
         
-        # 首先统一所有片段的格式和帧率
-        normalized_segments = []
-        for i, segment in enumerate(segment_files):
-            normalized_segment = os.path.join(temp_dir, f"normalized_{i:03d}.mp4")
-            normalize_cmd = [
-                "ffmpeg", "-y",
-                "-i", segment,
-                "-c:v", "libx264",
-                "-preset", "fast",
-                "-crf", "23",
-                "-pix_fmt", "yuv420p",
-                "-r", "60",  # 强制60fps
-                "-vsync", "cfr",  # 使用固定帧率
-                normalized_segment
+        # concat列表条目：(文件路径, 入点, 出点)，入点出点为None表示使用整个文件
+        concat_entries = []
+        entry_durations = []
+        
+        if stream_copy:
+            # 所有素材已符合目标格式：concat列表用inpoint/outpoint直接从原文件截取，
+            # 不再生成任何片段文件
+            logger.info("所有素材均符合目标格式，跳过重新编码，直接从原文件流复制截取")
+            # 入点对齐到不晚于规划起点的关键帧，截取内容与时长和规划保持一致
+            with ThreadPoolExecutor(max_workers=min(8, len(copy_paths))) as executor:
+                keyframe_times = dict(zip(
+                    copy_paths, executor.map(VideoMetadataExtractor.get_keyframe_times, copy_paths)
+                ))
+            for job in segment_jobs:
+                times = keyframe_times.get(job["video_path"])
+                if times:
+                    keyframe_index = bisect.bisect_right(times, job["start_time"]) - 1
+                    if keyframe_index >= 0:
+                        job["start_time"] = times[keyframe_index]
+            concat_entries = [
+                (job["video_path"], job["start_time"], job["start_time"] + job["segment_duration"])
+                for job in segment_jobs
             ]
-            try:
-                subprocess.run(normalize_cmd, check=True, capture_output=True)
-                normalized_segments.append(normalized_segment)
-            except subprocess.CalledProcessError as e:
-                logger.error(f"标准化视频片段失败: {e.stderr.decode('utf-8', errors='replace') if e.stderr else ''}")
-                normalized_segments.append(segment)  # 如果失败，使用原始片段
+            entry_durations = [job["segment_duration"] for job in segment_jobs]
+            encoded_audio = _encode_audio_track(audio_file, os.path.join(temp_dir, "audio.m4a"))
+        elif segment_jobs:
+            # 各片段互相独立，并行编码；每个ffmpeg使用threads个线程，总线程数约等于CPU核数
+            max_workers = max(1, min((os.cpu_count() or 1) // max(threads, 1), len(segment_jobs)))
+            logger.info(f"并行处理 {len(segment_jobs)} 个视频片段，并发数: {max_workers}")
+            # 检测一次可用的硬件编码器，所有片段使用同一编码器以保证可以流复制合并
+            encoder = HardwareAccelerator.get_optimal_encoder()
+            for job in segment_jobs:
+                job["encoder"] = encoder
+            if encoder != "libx264":
+                # 消费级显卡的硬件编码会话数有限，限制并发数
+                max_workers = min(max_workers, 3)
+                logger.info(f"使用硬件编码器截取片段: {encoder}")
+            
+            # 音频编码与片段编码互不依赖，放在同一个线程池中与片段编码同时进行，
+            # 最终合成时音频只需流复制
+            with ThreadPoolExecutor(max_workers=max_workers + 1) as executor:
+                audio_future = executor.submit(
+                    _encode_audio_track, audio_file, os.path.join(temp_dir, "audio.m4a")
+                )
+                results = list(executor.map(lambda job: _build_segment(job, threads), segment_jobs))
+                encoded_audio = audio_future.result()
+            
+            # 硬件编码有片段失败时，全部改用libx264重新编码，避免不同编码器的片段混合后无法流复制合并
+            if encoder != "libx264" and not all(results):
+                logger.warning(f"硬件编码器 {encoder} 处理部分片段失败，全部改用libx264重新编码")
+                cpu_workers = max(1, min((os.cpu_count() or 1) // max(threads, 1), len(segment_jobs)))
+                for job in segment_jobs:
+                    job["encoder"] = "libx264"
+                with ThreadPoolExecutor(max_workers=cpu_workers) as executor:
+                    results = list(executor.map(lambda job: _build_segment(job, threads), segment_jobs))
+            
+            # 按提交顺序收集结果
+            concat_entries = [(path, None, None) for path in results if path]
+            entry_durations = [job["segment_duration"] for job, path in zip(segment_jobs, results) if path]
         
-        # 创建新的片段列表文件
-        segments_list_path = os.path.join(temp_dir, "segments.txt")
-        with open(segments_list_path, "w") as f:
-            for segment in normalized_segments:
-                f.write(f"file '{segment}'\n")
+        # 如果没有有效片段，返回失败
+        if not concat_entries:
+            logger.error("没有有效的视频片段")
+            return None
         
-        # 使用concat分离器合并视频片段
-        concat_cmd = [
-            "ffmpeg", "-y",
-            "-f", "concat",
-            "-safe", "0",
-            "-i", segments_list_path,
-            "-c:v", "libx264",
-            "-preset", "fast",
-            "-crf", "23",
-            "-pix_fmt", "yuv420p",
-            "-r", "60",
-            "-vsync", "cfr",
-            "-max_muxing_queue_size", "1024",
-            concat_output_path
-        ]
+        concat_entries = _pad_concat_entries(
+            concat_entries, entry_durations, audio_duration,
+            shuffle=video_concat_mode == VideoConcatMode.random
+        )
         
-        try:
-            logger.info("合并视频片段...")
-            subprocess.run(concat_cmd, check=True, capture_output=True)
-            
-            # 验证合并后的视频时长
-            probe_cmd = [
-                "ffprobe",
-                "-v", "error",
-                "-show_entries", "format=duration",
-                "-of", "json",
-                concat_output_path
-            ]
-            probe_result = subprocess.run(probe_cmd, capture_output=True, text=True)
-            if probe_result.returncode == 0:
-                duration_info = json.loads(probe_result.stdout)
-                total_duration = float(duration_info["format"]["duration"])
-                logger.info(f"合并后视频总时长: {total_duration:.2f}秒")
-                
-                # 如果时长明显不对，尝试使用filter_complex方式重新合并
-                if total_duration > sum(segment_duration for segment_duration in [10.0, 4.16, 10.0]):
-                    logger.warning("检测到时长异常，使用filter_complex方式重新合并")
-                    
-                    # 创建concat文件，使用demuxer方式重新合并
-                    concat_file = os.path.join(temp_dir, "concat.txt")
-                    with open(concat_file, "w", encoding="utf-8") as f:
-                        for segment in normalized_segments:
-                            f.write(f"file '{segment}'\n")
-                    
-                    # 使用concat demuxer方式合并视频
-                    new_concat_cmd = [
-                        "ffmpeg", "-y",
-                        "-f", "concat",
-                        "-safe", "0",
-                        "-i", concat_file,
-                        "-c:v", "libx264",
-                        "-preset", "fast",
-                        "-crf", "23",
-                        "-pix_fmt", "yuv420p",
-                        "-r", "60",
-                        "-vsync", "cfr",
-                        concat_output_path
-                    ]
-                    
-                    logger.info(f"使用concat demuxer方式重新合并: {' '.join(new_concat_cmd)}")
-                    
-                    try:
-                        subprocess.run(new_concat_cmd, check=True, capture_output=True)
-                        
-                        # 再次验证时长
-                        probe_result = subprocess.run(probe_cmd, capture_output=True, text=True)
-                        if probe_result.returncode == 0:
-                            duration_info = json.loads(probe_result.stdout)
-                            new_duration = float(duration_info["format"]["duration"])
-                            logger.info(f"重新合并后视频总时长: {new_duration:.2f}秒")
-                    except subprocess.CalledProcessError as e:
-                        logger.error(f"使用concat demuxer方式合并失败: {e.stderr.decode('utf-8', errors='replace') if e.stderr else ''}")
-                        
-                        # 如果demuxer方式也失败，尝试使用改进的filter_complex方式
-                        logger.warning("尝试使用改进的filter_complex方式合并")
-                        
-                        # 构建改进的filter_complex字符串
-                        filter_parts = []
-                        
-                        # 第1步：为每个输入添加setpts过滤器
-                        for i in range(len(normalized_segments)):
-                            filter_parts.append(f"[{i}:v]setpts=PTS-STARTPTS[v{i}]")
-                        
-                        # 第2步：构建单个concat过滤器，连接所有视频
-                        concat_inputs = "".join(f"[v{i}]" for i in range(len(normalized_segments)))
-                        filter_parts.append(f"{concat_inputs}concat=n={len(normalized_segments)}:v=1:a=0[outv]")
-                        
-                        # 构建新的合并命令
-                        complex_cmd = ["ffmpeg", "-y"]
-                        for segment in normalized_segments:
-                            complex_cmd.extend(["-i", segment])
-                        
-                        complex_cmd.extend([
-                            "-filter_complex", ";".join(filter_parts),
-                            "-map", "[outv]",
-                            "-c:v", "libx264",
-                            "-preset", "fast",
-                            "-crf", "23",
-                            "-pix_fmt", "yuv420p",
-                            "-r", "60",
-                            concat_output_path
-                        ])
-                        
-                        logger.info(f"使用改进的filter_complex方式合并: {' '.join(complex_cmd)}")
-                        
-                        try:
-                            subprocess.run(complex_cmd, check=True, capture_output=True)
-                            
-                            # 再次验证时长
-                            probe_result = subprocess.run(probe_cmd, capture_output=True, text=True)
-                            if probe_result.returncode == 0:
-                                duration_info = json.loads(probe_result.stdout)
-                                new_duration = float(duration_info["format"]["duration"])
-                                logger.info(f"改进方式合并后视频总时长: {new_duration:.2f}秒")
-                        except subprocess.CalledProcessError as e:
-                            logger.error(f"使用改进的filter_complex方式合并也失败: {e.stderr.decode('utf-8', errors='replace') if e.stderr else ''}")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"合并视频片段失败: {e.stderr.decode('utf-8', errors='replace') if e.stderr else ''}")
-            return None
+        # 片段列表直接通过stdin传给ffmpeg，不再落盘生成segments.txt
+        concat_lines = []
+        for path, inpoint, outpoint in concat_entries:
+            concat_lines.append("file '{}'".format(os.path.abspath(path).replace("'", "'\\''")))
+            if inpoint is not None:
+                concat_lines.append(f"inpoint {inpoint:.3f}")
+                concat_lines.append(f"outpoint {outpoint:.3f}")
+        concat_list = ("\n".join(concat_lines) + "\n").encode("utf-8")
         
-        # 添加音频
+        # 所有片段编码参数一致（分辨率、帧率、GOP、时间基），用concat分离器直接流复制合并，
+        # 同一次调用中加入音频，不再先写出一个只有视频的中间文件再复制一遍
         final_output_cmd = [
             "ffmpeg", "-y",
-            "-i", concat_output_path,
-            "-i", audio_file,
-            "-map", "0:v:0",
+            "-fflags", "+genpts",
+            "-f", "concat",
+            "-safe", "0",
+            "-protocol_whitelist", "pipe,file",
+            "-i", "pipe:0",
+            "-i", encoded_audio or audio_file,
+            "-map", "0:v:0",  # 原文件可能带有音轨，只保留视频
             "-map", "1:a:0",
             "-c:v", "copy",
-            "-c:a", "aac",
-            "-b:a", "192k",
+        ]
+        # 音频已提前编码为AAC时直接流复制
+        if encoded_audio:
+            final_output_cmd.extend(["-c:a", "copy"])
+        else:
+            final_output_cmd.extend(["-c:a", "aac", "-b:a", "192k"])
+        final_output_cmd.extend([
             "-shortest",  # 确保输出长度最短
-            "-vsync", "cfr",  # 使用固定帧率
-            "-r", "60",  # 设置固定帧率为60fps
+            "-avoid_negative_ts", "make_zero",
+            "-max_muxing_queue_size", "1024",
             combined_video_path
-        ]
+        ])
         
-        try:
-            subprocess.run(final_output_cmd, check=True, capture_output=True)
-        except subprocess.CalledProcessError as e:
-            logger.error(f"添加音频失败: {e.stderr.decode('utf-8', errors='replace') if e.stderr else ''}")
+        logger.info("合并视频片段并添加音频...")
+        returncode, error_msg = _run_ffmpeg_bounded(final_output_cmd, input=concat_list)
+        if returncode != 0:
+            logger.error(f"合并视频片段失败: {error_msg}")
             return None
         
-        if os.path.exists(combined_video_path) and os.path.getsize(combined_video_path) > 0:
+        if _is_valid_mp4(combined_video_path):
             logger.info(f"视频合成成功: {combined_video_path}")
             return combined_video_path
         else:
@@ -466,12 +905,122 @@ def combine_videos(
         logger.error(f"视频合成过程中发生错误: {str(e)}")
         return None
     finally:
-        pass
-        # 清理临时文件
-        # try:
-        #     shutil.rmtree(temp_dir)
-        # except Exception as e:
-        #     logger.warning(f"清理临时目录失败: {str(e)}")
+        # 清理临时文件：片段和预编码音频在合成后都不再需要（流复制时concat列表直接引用原素材）；
+        # combine_videos_async在子进程中调用本函数，子进程退出会终止后台线程，这里同步删除
+        if 'temp_dir' in locals():
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def combine_videos_async(
+    combined_video_path: str,
+    video_paths: List[str],
+    audio_file: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: int = 5,
+    threads: int = 2,
+) -> multiprocessing.Process:
+    """
+    在独立子进程中执行combine_videos，返回已启动的进程对象。
+    
+    子进程退出后其占用的内存由操作系统整体回收，不会滞留在调用方进程中；
+    调用方通过process.join()等待完成，并根据combined_video_path是否生成判断结果。
+    需要同时合成多个视频时，可直接启动多个进程或配合ProcessPoolExecutor使用；
+    HardwareAccelerator.encode_slot的编码并发上限只在单个进程内生效，
+    同时运行的子进程数量需要由调用方控制（例如限制ProcessPoolExecutor的max_workers）。
+    
+    Args:
+        参数与combine_videos一致
+        
+    Returns:
+        已启动的合成进程
+    """
+    process = multiprocessing.Process(
+        target=combine_videos,
+        kwargs={
+            "combined_video_path": combined_video_path,
+            "video_paths": list(video_paths),
+            "audio_file": audio_file,
+            "video_aspect": video_aspect,
+            "video_concat_mode": video_concat_mode,
+            "video_transition_mode": video_transition_mode,
+            "max_clip_duration": max_clip_duration,
+            "threads": threads,
+        },
+        name=f"combine-{os.path.basename(combined_video_path)}",
+    )
+    process.start()
+    logger.info(f"视频合成子进程已启动: pid={process.pid}, 输出={combined_video_path}")
+    return process
+
+
+def _run_ffmpeg_with_progress(cmd: List[str], total_duration: float = 0, encoder: str = "libx264") -> bool:
+    """
+    执行ffmpeg命令并在日志中输出进度
+    
+    进度通过-progress pipe:1以key=value形式写到stdout，按块读取解析；
+    已知总时长时每推进约10%才记录一次日志。
+    
+    Args:
+        cmd: ffmpeg命令
+        total_duration: 输出的预计总时长（秒），用于计算进度百分比
+        encoder: 使用的视频编码器，用于占用对应的编码并发名额
+        
+    Returns:
+        ffmpeg是否成功退出
+    """
+    with HardwareAccelerator.encode_slot(encoder):
+        return _run_ffmpeg_progress_loop(cmd, total_duration)
+
+
+def _run_ffmpeg_progress_loop(cmd: List[str], total_duration: float) -> bool:
+    """_run_ffmpeg_with_progress的实际执行部分"""
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats", "-loglevel", "error"] + cmd[1:]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    # stderr在单独的线程中读取，避免管道写满导致ffmpeg阻塞；只保留最后的输出用于报错
+    stderr_tail = collections.deque(maxlen=20)
+    
+    def drain_stderr():
+        for raw_line in process.stderr:
+            stderr_tail.append(raw_line.decode("utf-8", errors="replace").rstrip())
+    
+    stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+    stderr_thread.start()
+    
+    # 按块读取进度输出，解析key=value
+    total_us = total_duration * 1_000_000
+    next_report_us = 0.0
+    pending = b""
+    fd = process.stdout.fileno()
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            key, _, value = line.partition(b"=")
+            if key != b"out_time_us":
+                continue
+            try:
+                out_time_us = int(value)
+            except ValueError:
+                continue
+            if total_us > 0 and out_time_us >= next_report_us:
+                logger.info(f"视频合成进度: {min(out_time_us / total_us, 1.0):.0%}")
+                next_report_us = out_time_us + total_us * 0.1
+    
+    process.wait()
+    stderr_thread.join()
+    
+    if process.returncode != 0:
+        logger.error(f"视频生成失败，FFmpeg返回码: {process.returncode}")
+        logger.error("错误输出: " + "\n".join(stderr_tail))
+        return False
+    
+    return True
 
 
 def generate_video(
@@ -510,6 +1059,13 @@ def generate_video(
         temp_dir = os.path.join(os.path.dirname(output_file), f"temp_gen_{str(uuid.uuid4())}")
         os.makedirs(temp_dir, exist_ok=True)
         
+        # 硬件编码器检测（首次需要启动ffmpeg做测试编码）和音频时长探测与视频元数据读取互不依赖，
+        # 放到后台线程中同时进行，用到时再取结果
+        background_executor = ThreadPoolExecutor(max_workers=2)
+        encoder_future = background_executor.submit(HardwareAccelerator.get_optimal_encoder)
+        audio_duration_future = background_executor.submit(VideoMetadataExtractor.get_audio_duration, audio_path)
+        background_executor.shutdown(wait=False)
+        
         # 检查视频是否已预处理过
         filename = os.path.basename(video_path)
         is_preprocessed = "_processed" in filename or "proc_" in filename
@@ -526,70 +1082,39 @@ def generate_video(
         logger.info(f"目标视频尺寸: {target_width}x{target_height}")
         
         # 获取音频时长确定最终视频长度
-        audio_info_cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", audio_path]
-        audio_info = json.loads(subprocess.check_output(audio_info_cmd, universal_newlines=True))
-        audio_duration = float(audio_info["format"]["duration"])
+        # 经由元数据缓存获取，combine_videos阶段已探测过同一音频
+        audio_duration = audio_duration_future.result()
+        if audio_duration <= 0:
+            logger.error(f"无法获取音频时长: {audio_path}")
+            return None
         logger.info(f"音频时长: {audio_duration:.2f}秒")
         
-        # 处理背景音乐
+        # 背景音乐在混音时一并处理：-stream_loop循环输入，淡出与音量在同一个滤镜图中完成
         bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
-        processed_bgm = None
         
+        # 配音与背景音乐的混音滤镜，与视频滤镜放在同一次ffmpeg调用中完成，不再生成中间音频文件
+        # 输入顺序：0为视频，1为配音，2为背景音乐
+        audio_inputs = ["-i", audio_path]
         if bgm_file and os.path.exists(bgm_file):
             logger.info(f"处理背景音乐: {os.path.basename(bgm_file)}")
-            processed_bgm = os.path.join(temp_dir, "processed_bgm.mp3")
-            bgm_cmd = [
-                "ffmpeg", "-y",
+            fade_start = max(audio_duration - 3, 0)
+            audio_inputs.extend([
+                "-stream_loop", "-1",
+                "-t", f"{audio_duration:.3f}",  # 循环输入只读取到配音时长为止
                 "-i", bgm_file,
-                "-af", f"volume={params.bgm_volume},afade=t=out:st={audio_duration-3}:d=3",
-                "-to", str(audio_duration),
-                processed_bgm
-            ]
-            
-            try:
-                subprocess.run(bgm_cmd, check=True, capture_output=True)
-                if not os.path.exists(processed_bgm) or os.path.getsize(processed_bgm) == 0:
-                    logger.error("背景音乐处理失败")
-                    processed_bgm = None
-            except subprocess.CalledProcessError as e:
-                logger.error(f"背景音乐处理失败: {e.stderr.decode('utf-8', errors='replace') if e.stderr else ''}")
-                processed_bgm = None
-        
-        # 合并音频（主音频和背景音乐）
-        merged_audio = os.path.join(temp_dir, "merged_audio.aac")
-        
-        if processed_bgm:
-            # 使用filter_complex混合音频
-            audio_cmd = [
-                "ffmpeg", "-y",
-                "-i", audio_path,
-                "-i", processed_bgm,
-                "-filter_complex", f"[0:a]volume={params.voice_volume}[a1];[1:a]volume={params.bgm_volume}[a2];[a1][a2]amix=inputs=2:duration=longest[aout]",
-                "-map", "[aout]",
-                "-c:a", "aac",
-                "-b:a", "192k",
-                merged_audio
-            ]
+            ])
+            # 以主音频时长为准混合
+            audio_graph = (
+                f"[1:a]volume={params.voice_volume}[a1];"
+                f"[2:a]volume={params.bgm_volume},afade=t=out:st={fade_start}:d=3[a2];"
+                f"[a1][a2]amix=inputs=2:duration=first[aout]"
+            )
+        elif float(params.voice_volume) == 1.0:
+            # 只有配音且音量不变时无需经过滤镜，直接映射配音流
+            audio_graph = ""
         else:
             # 只处理主音频
-            audio_cmd = [
-                "ffmpeg", "-y",
-                "-i", audio_path,
-                "-af", f"volume={params.voice_volume}",
-                "-c:a", "aac",
-                "-b:a", "192k",
-                merged_audio
-            ]
-        
-        logger.info("处理音频...")
-        try:
-            subprocess.run(audio_cmd, check=True, capture_output=True)
-            if not os.path.exists(merged_audio) or os.path.getsize(merged_audio) == 0:
-                logger.error("音频处理失败")
-                return None
-        except subprocess.CalledProcessError as e:
-            logger.error(f"音频处理失败: {e.stderr.decode('utf-8', errors='replace') if e.stderr else ''}")
-            return None
+            audio_graph = f"[1:a]volume={params.voice_volume}[aout]"
             
         # 处理字幕
         subtitle_filter = ""
@@ -603,98 +1128,13 @@ def generate_video(
                 
                 logger.info(f"处理字幕文件: {os.path.basename(subtitle_path)}")
                 
-                # 创建ASS字幕
-                ass_subtitle = os.path.join(temp_dir, "subtitle.ass")
-                subtitle_cmd = [
-                    "ffmpeg", "-y",
-                    "-i", subtitle_path,
-                    "-f", "ass",
-                    ass_subtitle
-                ]
-                
-                logger.info("转换字幕格式...")
-                subprocess.run(subtitle_cmd, check=True, capture_output=True, encoding='utf-8', errors='replace')
+                # subtitles滤镜可以直接读取SRT，force_style同样生效，
+                # 无需先单独启动一次ffmpeg把字幕转换成ASS
+                subtitle_filter = _build_subtitle_filter(subtitle_path, params)
+                logger.info(f"字幕滤镜设置: {subtitle_filter}")
                 
-                if os.path.exists(ass_subtitle):
-                    try:
-                        # 统一使用绝对路径+正斜杠
-                        safe_subtitle_path = os.path.abspath(ass_subtitle).replace('\\', '/')
-                        logger.debug(f"原始字幕路径: {ass_subtitle}")
-                        logger.debug(f"处理后路径 (1): {safe_subtitle_path}")
-                        
-                        # Windows特殊处理
-                        if os.name == "nt":
-                            if ':' in safe_subtitle_path:
-                                drive_part, path_part = safe_subtitle_path.split(':', 1)
-                                # 使用原始字符串r来处理反斜杠，避免f-string语法错误
-                                safe_subtitle_path = drive_part + r'\:' + path_part
-                                logger.debug(f"Windows路径处理 (2): {safe_subtitle_path}")
-                            
-                            # 包裹在单引号中 - 确保FFmpeg正确解析路径
-                            if not safe_subtitle_path.startswith("'") and not safe_subtitle_path.endswith("'"):
-                                safe_subtitle_path = f"'{safe_subtitle_path}'"
-                                logger.debug(f"添加引号 (3): {safe_subtitle_path}")
-                        # 其他系统直接引用
-                        else:
-                            safe_subtitle_path = shlex.quote(safe_subtitle_path)
-                            logger.debug(f"非Windows路径处理: {safe_subtitle_path}")
-                        
-                        # 确保字体名称安全
-                        safe_font_name = params.font_name.replace(",", "\\,").replace(":", "\\:")
-                        
-                        # 确定字幕位置
-                        alignment = 2  # 默认底部居中
-                        if params.subtitle_position == "top":
-                            alignment = 8  # 顶部居中
-                        elif params.subtitle_position == "center":
-                            alignment = 5  # 中间居中
-                            
-                        # 计算垂直边距
-                        vertical_margin = 50
-                        
-                        # 构建字幕滤镜
-                        subtitle_filter = f"subtitles={safe_subtitle_path}:force_style='FontName={safe_font_name},FontSize={params.font_size},PrimaryColour=&H{params.text_fore_color[1:]}&,OutlineColour=&H{params.stroke_color[1:]}&,BorderStyle=1,Outline={params.stroke_width},Alignment={alignment},MarginV={vertical_margin}'"
-
-                        logger.info(f"字幕滤镜设置: {subtitle_filter}")
-                    except Exception as e:
-                        logger.error(f"字幕路径处理失败: {str(e)}")
-                        # 备选方案 - 简化处理，防止出错
-                        try:
-                            raw_path = ass_subtitle.replace('\\', '/')
-                            if os.name == "nt" and ":" in raw_path:
-                                # 最简单的处理方式
-                                drive, rest = raw_path.split(":", 1)
-                                raw_path = f"{drive}\\:{rest}"
-                            # 计算垂直边距
-                            vertical_margin = 50
-                            # 构建字幕滤镜
-                            subtitle_filter = f"subtitles='{raw_path}':force_style='FontName={params.font_name},FontSize={params.font_size},Alignment={alignment},MarginV={vertical_margin}'"
-                            logger.info(f"使用备选字幕滤镜: {subtitle_filter}")
-                        except Exception as e2:
-                            logger.error(f"备选字幕处理也失败: {str(e2)}")
-                            subtitle_filter = ""  # 失败时不添加字幕
-                    
-                    # 获取视频尺寸(用于日志记录和调试，不影响字幕处理)
-                    try:
-                        # 使用JSON格式获取视频尺寸
-                        json_cmd = [
-                            "ffprobe",
-                            "-v", "error",
-                            "-select_streams", "v:0",
-                            "-show_entries", "stream=width,height",
-                            "-of", "json",
-                            video_path
-                        ]
-                        json_result = subprocess.run(json_cmd, capture_output=True, encoding='utf-8', errors='replace', check=False).stdout
-                        video_info = json.loads(json_result)
-                        if "streams" in video_info and video_info["streams"]:
-                            width = int(video_info["streams"][0].get("width", 1080))
-                            height = int(video_info["streams"][0].get("height", 1920))
-                            logger.info(f"视频尺寸: {width}x{height}")
-                        else:
-                            logger.warning("未找到视频流信息")
-                    except Exception as e:
-                        logger.warning(f"获取视频尺寸失败: {str(e)}")
+                # 视频尺寸直接取自前面已获取的元数据(仅用于日志记录和调试)，不再单独启动ffprobe
+                logger.info(f"视频尺寸: {metadata.width}x{metadata.height}")
             except Exception as e:
                 logger.error(f"处理字幕时出错: {str(e)}")
                 subtitle_filter = ""
@@ -703,7 +1143,7 @@ def generate_video(
         filter_complex = []
         
         # 添加可能需要的其他滤镜
-        if is_preprocessed:
+        if is_preprocessed and VideoMetadataExtractor.needs_pixel_format_conversion(metadata):
             # 如果已预处理，只添加必要的滤镜
             filter_complex.append("format=yuv420p")
 
@@ -714,245 +1154,124 @@ def generate_video(
         
         # 创建水印滤镜 - 使用项目自带的字体目录
         watermark_vf = ""
-        try:
-            # 尝试获取与字幕相同的字体
-            font_name = params.font_name if params.font_name else "STHeitiMedium.ttc"
-            font_path = os.path.join(utils.font_dir(), font_name)
+        # 未设置水印文字时不添加drawtext滤镜
+        if params.watermark_text:
+            watermark_font_size = params.watermark_size
+            try:
+                # 尝试获取与字幕相同的字体
+                font_name = params.font_name if params.font_name else "STHeitiMedium.ttc"
+                font_path = os.path.join(utils.font_dir(), font_name)
             
-            # 如果字体不存在，尝试项目中的其他常用字体
-            if not os.path.exists(font_path):
-                for common_font in ["STHeitiMedium.ttc", "arial.ttf", "simhei.ttf"]:
-                    test_path = os.path.join(utils.font_dir(), common_font)
-                    if os.path.exists(test_path):
-                        font_path = test_path
-                        logger.info(f"使用替代字体: {common_font}")
-                        break
+                # 如果字体不存在，尝试项目中的其他常用字体
+                if not os.path.exists(font_path):
+                    for common_font in ["STHeitiMedium.ttc", "arial.ttf", "simhei.ttf"]:
+                        test_path = os.path.join(utils.font_dir(), common_font)
+                        if os.path.exists(test_path):
+                            font_path = test_path
+                            logger.info(f"使用替代字体: {common_font}")
+                            break
             
-            # 确保字体存在
-            if os.path.exists(font_path):
-                # 准备字体路径
-                safe_font_path = os.path.abspath(font_path).replace('\\', '/')
+                # 确保字体存在
+                if os.path.exists(font_path):
+                    # 准备字体路径
+                    safe_font_path = os.path.abspath(font_path).replace('\\', '/')
                 
-                # Windows特殊处理
-                if os.name == "nt" and ":" in safe_font_path:
-                    drive, path = safe_font_path.split(":", 1)
-                    safe_font_path = f"{drive}\\:{path}"
+                    # Windows特殊处理
+                    if os.name == "nt" and ":" in safe_font_path:
+                        drive, path = safe_font_path.split(":", 1)
+                        safe_font_path = f"{drive}\\:{path}"
                 
-                # 添加引号                                             
-                if not safe_font_path.startswith("'") and not safe_font_path.endswith("'"):
-                    safe_font_path = f"'{safe_font_path}'"
+                    # 添加引号                                             
+                    if not safe_font_path.startswith("'") and not safe_font_path.endswith("'"):
+                        safe_font_path = f"'{safe_font_path}'"
                 
-                watermark_font_size = params.watermark_size
-                # 创建带有字体的水印滤镜 - 使用计算表达式替代center关键字
-                watermark_vf = f"drawtext=text='{params.watermark_text}':fontfile={safe_font_path}:fontsize={watermark_font_size}:fontcolor=white@0.3:x=(w-text_w)/2:y=(h-text_h)/2"
-                logger.info(f"创建带字体的水印滤镜: {watermark_vf}")
-            else:
-                # 找不到字体时使用简单版本
+                    # 创建带有字体的水印滤镜 - 使用计算表达式替代center关键字
+                    watermark_vf = f"drawtext=text='{params.watermark_text}':fontfile={safe_font_path}:fontsize={watermark_font_size}:fontcolor=white@0.3:x=(w-text_w)/2:y=(h-text_h)/2"
+                    logger.info(f"创建带字体的水印滤镜: {watermark_vf}")
+                else:
+                    # 找不到字体时使用简单版本
+                    watermark_vf = f"drawtext=text='{params.watermark_text}':fontsize={watermark_font_size}:fontcolor=white@0.3:x=(w-text_w)/2:y=(h-text_h)/2"
+                    logger.info(f"未找到字体，使用简单水印滤镜: {watermark_vf}")
+            except Exception as e:
+                # 出错时使用最简单版本
                 watermark_vf = f"drawtext=text='{params.watermark_text}':fontsize={watermark_font_size}:fontcolor=white@0.3:x=(w-text_w)/2:y=(h-text_h)/2"
-                logger.info(f"未找到字体，使用简单水印滤镜: {watermark_vf}")
-        except Exception as e:
-            # 出错时使用最简单版本
-            watermark_vf = f"drawtext=text='{params.watermark_text}':fontsize={watermark_font_size}:fontcolor=white@0.3:x=(w-text_w)/2:y=(h-text_h)/2"
-            logger.error(f"创建水印滤镜出错: {str(e)}，使用简单版本")
+                logger.error(f"创建水印滤镜出错: {str(e)}，使用简单版本")
         
-        logger.info(f"最终水印滤镜: {watermark_vf}")
+            logger.info(f"最终水印滤镜: {watermark_vf}")
         
-        # 最终视频处理命令
-        if subtitle_filter:
-            # 有字幕的情况下，使用复杂filter_complex
-            vf = ""
-            if filter_complex:
-                # 如果有其他滤镜，先添加
-                base_filters = ",".join(filter_complex)
-                vf = f"{base_filters},{subtitle_filter}"
-            else:
-                vf = subtitle_filter
+        # 字幕、水印等所有视频滤镜合并为一条滤镜链，一次编码完成，不再生成字幕中间文件
+        def build_final_cmd(with_subtitle: bool, encoder: str) -> list:
+            video_filters = list(filter_complex)
+            if with_subtitle and subtitle_filter:
+                video_filters.append(subtitle_filter)
+            if watermark_vf:
+                video_filters.append(watermark_vf)
+            vf = ",".join(video_filters)
             
-            # 为Windows特殊处理，避免命令行过长
-            if os.name == 'nt':
-                # 创建滤镜文件 - 仅包含字幕滤镜
-                filters_file = os.path.join(temp_dir, "subtitle_filters.txt")
-                try:
-                    with open(filters_file, "w", encoding="utf-8") as f:
-                        f.write(vf)  # 只写入字幕滤镜
-                    
-                    # 先应用字幕滤镜，生成中间视频
-                    intermediate_video = os.path.join(temp_dir, "with_subtitle.mp4")
-                    subtitle_cmd = [
-                        "ffmpeg", "-y",
-                        "-i", video_path,
-                        "-filter_complex_script", filters_file,
-                        "-c:v", "libx264",
-                        "-preset", "ultrafast",  # 使用超快速预设，因为这只是中间文件
-                        "-crf", "18",  # 保持较高质量
-                        "-pix_fmt", "yuv420p",
-                        intermediate_video
-                    ]
-                    
-                    logger.info("第一步：应用字幕滤镜...")
-                    logger.info(f"字幕滤镜: {vf}")
-                    subprocess.run(subtitle_cmd, check=True, capture_output=True)
-                    
-                    # 检查中间文件是否生成成功
-                    if not os.path.exists(intermediate_video) or os.path.getsize(intermediate_video) == 0:
-                        raise Exception("应用字幕滤镜后，中间文件创建失败")
-                    
-                    # 第二步：应用水印滤镜到中间视频，并添加音频
-                    logger.info("第二步：应用水印滤镜并添加音频...")
-                    logger.info(f"水印滤镜: {watermark_vf}")
-                    
-                    final_cmd = [
-                        "ffmpeg", "-y",
-                        "-i", intermediate_video,
-                        "-i", merged_audio,
-                        "-vf", watermark_vf,  # 应用水印滤镜
-                        "-map", "0:v",
-                        "-map", "1:a",
-                        "-c:v", "libx264",
-                        "-preset", "medium",
-                        "-crf", "23",
-                        "-c:a", "copy",
-                        "-shortest",
-                        "-pix_fmt", "yuv420p",
-                        "-max_muxing_queue_size", "1024",
-                        "-movflags", "+faststart",
-                        output_file
-                    ]
-                except Exception as e:
-                    logger.error(f"应用滤镜失败: {str(e)}")
-                    # 回退到没有滤镜的版本
-                    final_cmd = [
-                        "ffmpeg", "-y",
-                        "-i", video_path,
-                        "-i", merged_audio,
-                        "-map", "0:v",
-                        "-map", "1:a",
-                        "-c:v", "libx264",
-                        "-preset", "medium",
-                        "-crf", "23",
-                        "-c:a", "copy",
-                        "-shortest",
-                        "-pix_fmt", "yuv420p",
-                        "-max_muxing_queue_size", "1024",
-                        "-movflags", "+faststart",
-                        output_file
-                    ]
-            else:
-                # 非Windows系统，也采用两步处理方式确保最大兼容性
-                try:
-                    # 先应用字幕滤镜，生成中间视频
-                    intermediate_video = os.path.join(temp_dir, "with_subtitle.mp4")
-                    subtitle_cmd = [
-                        "ffmpeg", "-y",
-                        "-i", video_path,
-                        "-filter_complex", vf,  # 应用字幕滤镜
-                        "-c:v", "libx264",
-                        "-preset", "ultrafast",  # 使用超快速预设
-                        "-crf", "18",  # 保持较高质量
-                        "-pix_fmt", "yuv420p",
-                        intermediate_video
-                    ]
-                    
-                    logger.info("第一步：应用字幕滤镜...")
-                    logger.info(f"字幕滤镜: {vf}")
-                    subprocess.run(subtitle_cmd, check=True, capture_output=True)
-                    
-                    # 检查中间文件是否生成成功
-                    if not os.path.exists(intermediate_video) or os.path.getsize(intermediate_video) == 0:
-                        raise Exception("应用字幕滤镜后，中间文件创建失败")
-                    
-                    # 第二步：应用水印滤镜到中间视频，并添加音频
-                    logger.info("第二步：应用水印滤镜并添加音频...")
-                    logger.info(f"水印滤镜: {watermark_vf}")
-                    
-                    final_cmd = [
-                        "ffmpeg", "-y",
-                        "-i", intermediate_video,
-                        "-i", merged_audio,
-                        "-vf", watermark_vf,  # 应用水印滤镜
-                        "-map", "0:v",
-                        "-map", "1:a",
-                        "-c:v", "libx264",
-                        "-preset", "medium",
-                        "-crf", "23",
-                        "-c:a", "copy",
-                        "-shortest",
-                        "-pix_fmt", "yuv420p",
-                        "-max_muxing_queue_size", "1024",
-                        "-movflags", "+faststart",
-                        output_file
-                    ]
-                except Exception as e:
-                    logger.error(f"应用滤镜失败: {str(e)}")
-                    # 在某一步失败时回退到基本方式
-                    final_cmd = [
-                        "ffmpeg", "-y",
-                        "-i", video_path,
-                        "-i", merged_audio,
-                        "-filter_complex", vf,
-                        "-map", "0:v",
-                        "-map", "1:a",
-                        "-c:v", "libx264",
-                        "-preset", "medium",
-                        "-crf", "23",
-                        "-c:a", "copy",
-                        "-shortest",
-                        "-pix_fmt", "yuv420p",
-                        "-max_muxing_queue_size", "1024",
-                        "-movflags", "+faststart",
-                        output_file
-                    ]
-        else:
-            # 只有水印，没有字幕
-            vf = watermark_vf
-            if filter_complex:
-                vf = f"{','.join(filter_complex)},{watermark_vf}"
+            cmd = ["ffmpeg", "-y", "-i", video_path] + audio_inputs
             
-            # 在Windows和非Windows系统上使用相同的简单方法
-            final_cmd = [
-                "ffmpeg", "-y",
-                "-i", video_path,
-                "-i", merged_audio,
-                "-vf", vf,
-                "-map", "0:v",
-                "-map", "1:a",
-                "-c:v", "libx264",
-                "-preset", "medium",
-                "-crf", "23",
-                "-c:a", "copy",
+            # 视频滤镜与混音滤镜合成一张滤镜图
+            graph = ";".join(part for part in (f"[0:v]{vf}[vout]" if vf else "", audio_graph) if part)
+            
+            if graph and os.name == 'nt':
+                # Windows下将滤镜写入文件，避免命令行过长和路径转义问题
+                filters_file = os.path.join(temp_dir, "filters.txt")
+                with open(filters_file, "w", encoding="utf-8") as f:
+                    f.write(graph)
+                cmd.extend(["-filter_complex_script", filters_file])
+            elif graph:
+                cmd.extend(["-filter_complex", graph])
+            
+            cmd.extend(["-map", "[vout]" if vf else "0:v", "-map", "[aout]" if audio_graph else "1:a:0"])
+            if vf:
+                cmd.extend(EncoderConfig.get_final_encoder_args(
+                    encoder, cpu_preset=config.app.get("ffmpeg_cpu_preset", "veryfast")
+                ))
+                cmd.extend(["-pix_fmt", "yuv420p"])
+            else:
+                # 没有任何视频滤镜时只需封装，直接复制视频流，省去整遍解码与编码
+                cmd.extend(["-c:v", "copy"])
+            if not audio_graph and audio_path.lower().endswith((".m4a", ".aac")):
+                # 配音本身就是AAC且未经处理，直接复制，避免再做一次有损编码
+                cmd.extend(["-c:a", "copy"])
+            else:
+                cmd.extend(["-c:a", "aac", "-b:a", "192k"])
+            cmd.extend([
                 "-shortest",
-                "-pix_fmt", "yuv420p",
                 "-max_muxing_queue_size", "1024",
                 "-movflags", "+faststart",
                 output_file
-            ]
+            ])
+            return cmd
         
-        logger.info("生成最终视频...")
+        # 有硬件编码器时成片编码交给GPU，失败再回退到libx264
+        if filter_complex or subtitle_filter or watermark_vf:
+            final_encoder = encoder_future.result()
+        else:
+            final_encoder = "libx264"  # 无视频滤镜时直接复制视频流，不会用到编码器
+        logger.info(f"生成最终视频，编码器: {final_encoder}")
+        final_cmd = build_final_cmd(with_subtitle=True, encoder=final_encoder)
         logger.info(f"FFmpeg命令: {' '.join(final_cmd)}")
+        success = _run_ffmpeg_with_progress(final_cmd, audio_duration, final_encoder)
         
-        final_process = subprocess.Popen(
-            final_cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE, 
-            universal_newlines=True
-        )
+        if not success and final_encoder != "libx264":
+            logger.warning(f"硬件编码器 {final_encoder} 生成视频失败，改用libx264重试")
+            final_encoder = "libx264"
+            final_cmd = build_final_cmd(with_subtitle=True, encoder=final_encoder)
+            logger.info(f"FFmpeg命令: {' '.join(final_cmd)}")
+            success = _run_ffmpeg_with_progress(final_cmd, audio_duration, final_encoder)
         
-        # 显示处理进度
-        for line in final_process.stderr:
-            if "time=" in line and "bitrate=" in line:
-                logger.info(f"视频合成进度: {line.strip()}")
-            elif "error" in line.lower():
-                logger.error(f"FFmpeg错误: {line.strip()}")
+        if not success and subtitle_filter:
+            # 字幕滤镜失败时去掉字幕重试，保证至少生成视频
+            logger.warning("应用字幕滤镜失败，尝试不带字幕生成视频")
+            final_cmd = build_final_cmd(with_subtitle=False, encoder=final_encoder)
+            logger.info(f"FFmpeg命令: {' '.join(final_cmd)}")
+            success = _run_ffmpeg_with_progress(final_cmd, audio_duration, final_encoder)
         
-        final_process.wait()
-        
-        if final_process.returncode != 0:
-            error_output = final_process.stderr.read()
-            logger.error(f"视频生成失败，FFmpeg返回码: {final_process.returncode}")
-            logger.error(f"错误输出: {error_output}")
+        if not success:
             return None
             
-        if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+        if not _is_nonempty_file(output_file):
             logger.error("最终视频文件不存在或为空")
             return None
             
@@ -963,13 +1282,15 @@ def generate_video(
         logger.error(f"视频生成过程中出错: {str(e)}")
         return None
     finally:
-        # 清理临时文件
-        try:
-            if 'temp_dir' in locals() and os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-                logger.info("已清理临时文件")
-        except Exception as e:
-            logger.error(f"清理临时文件失败: {str(e)}")
+        # 清理临时文件：放到后台线程中删除，不阻塞返回结果
+        if 'temp_dir' in locals() and os.path.exists(temp_dir):
+            threading.Thread(
+                target=shutil.rmtree,
+                args=(temp_dir,),
+                kwargs={"ignore_errors": True},
+                daemon=True
+            ).start()
+            logger.info("已在后台清理临时文件")
 
 
 if __name__ == "__main__":
@@ -989,23 +1310,14 @@ if __name__ == "__main__":
             
         # 获取视频元数据
         try:
-            # 使用JSON格式获取视频尺寸
-            json_cmd = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=width,height",
-                "-of", "json",
-                input_video
-            ]
-            json_result = subprocess.run(json_cmd, capture_output=True, encoding='utf-8', errors='replace', check=False).stdout
-            video_info = json.loads(json_result)
+            # 与其他元数据查询共用FFprobeExtractor的探测与缓存
+            video_info = FFprobeExtractor.get_basic_metadata(input_video)
             
             width = 1920
             height = 1080
-            if "streams" in video_info and video_info["streams"]:
-                width = int(video_info["streams"][0].get("width", 1920))
-                height = int(video_info["streams"][0].get("height", 1080))
+            if video_info["width"] > 0 and video_info["height"] > 0:
+                width = video_info["width"]
+                height = video_info["height"]
                 print(f"视频尺寸: {width}x{height}")
             else:
                 print("警告: 未找到视频流信息，使用默认尺寸: 1920x1080")
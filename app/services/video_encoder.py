@@ -5,6 +5,7 @@ import shutil
 import time
 import logging
 import re
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
@@ -128,9 +129,79 @@ class EncoderConfig:
         
         return params
 
+    @staticmethod
+    def get_segment_encoder_args(encoder: str, quality: int = 23) -> list:
+        """
+        获取片段截取使用的编码参数（速度优先，画质与libx264 -crf 23相当）
+        
+        Args:
+            encoder: 编码器名称（h264_nvenc、h264_qsv、h264_amf或libx264）
+            quality: 恒定质量值，含义与crf一致
+            
+        Returns:
+            ffmpeg编码参数列表
+        """
+        if encoder == "h264_nvenc":
+            return ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq",
+                    "-rc", "vbr", "-cq", str(quality), "-b:v", "0"]
+        if encoder == "h264_qsv":
+            return ["-c:v", "h264_qsv", "-preset", "faster", "-global_quality", str(quality)]
+        if encoder == "h264_amf":
+            return ["-c:v", "h264_amf", "-quality", "speed",
+                    "-rc", "cqp", "-qp_i", str(quality), "-qp_p", str(quality)]
+        # 片段都很短且之后直接流复制拼接：关闭B帧、缩短前瞻、使用切片线程换取编码速度
+        return ["-c:v", "libx264", "-preset", "faster", "-tune", "fastdecode", "-crf", str(quality),
+                "-x264-params", "sliced-threads=1:sync-lookahead=0:rc-lookahead=10:bframes=0"]
+
+    @staticmethod
+    def get_final_encoder_args(encoder: str, quality: int = 23, cpu_preset: str = "veryfast") -> list:
+        """
+        获取成片编码使用的参数（恒定质量模式，不指定固定码率）
+        
+        Args:
+            encoder: 编码器名称（h264_nvenc、h264_qsv、h264_amf或libx264）
+            quality: 恒定质量值，含义与crf一致
+            cpu_preset: libx264使用的预设，CRF相同时更快的预设只会让文件略大
+            
+        Returns:
+            ffmpeg编码参数列表
+        """
+        if encoder == "h264_nvenc":
+            return ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq",
+                    "-rc", "vbr", "-cq", str(quality), "-b:v", "0"]
+        if encoder == "h264_qsv":
+            return ["-c:v", "h264_qsv", "-preset", "medium", "-global_quality", str(quality)]
+        if encoder == "h264_amf":
+            return ["-c:v", "h264_amf", "-quality", "balanced",
+                    "-rc", "cqp", "-qp_i", str(quality), "-qp_p", str(quality)]
+        return ["-c:v", "libx264", "-preset", cpu_preset, "-crf", str(quality)]
+
 class HardwareAccelerator:
     """硬件加速检测与配置类"""
     _ENCODERS_CACHE = None  # 静态缓存
+    _HWACCELS_CACHE = None  # 硬件解码方式缓存
+    _OPTIMAL_ENCODER_CACHE = {}  # 按首选GPU缓存实测可用的编码器
+    _OPTIMAL_ENCODER_LOCK = threading.Lock()
+    
+    # 进程内共享的编码并发上限：同一进程中多个任务同时合成时，避免libx264进程互相争抢CPU，
+    # 或超出消费级显卡的硬件编码会话数。
+    # 注意这是threading信号量，每个进程各有一份：combine_videos_async启动的子进程不受父进程的名额约束，
+    # 多个子进程同时合成时总并发数是各进程上限之和，需要由调用方控制同时启动的子进程数量
+    _CPU_ENCODE_SLOTS = threading.BoundedSemaphore(max(1, (os.cpu_count() or 4) // 2))
+    _GPU_ENCODE_SLOTS = threading.BoundedSemaphore(3)
+    
+    @staticmethod
+    @contextmanager
+    def encode_slot(encoder: str = "libx264"):
+        """
+        占用一个编码并发名额：硬件编码器只占用GPU会话名额，libx264占用CPU名额
+        
+        硬件编码不再额外占用CPU名额，否则在2~3核的机器上CPU名额只有1个，GPU编码会被完全串行化。
+        """
+        is_gpu_encoder = any(name in encoder for name in ("nvenc", "qsv", "amf"))
+        slots = HardwareAccelerator._GPU_ENCODE_SLOTS if is_gpu_encoder else HardwareAccelerator._CPU_ENCODE_SLOTS
+        with slots:
+            yield
     
     @staticmethod
     def detect_available_encoders(force_refresh=False):
@@ -163,6 +234,29 @@ class HardwareAccelerator:
         HardwareAccelerator._ENCODERS_CACHE = encoders
         return encoders
     
+    @staticmethod
+    def detect_hwaccels(force_refresh=False):
+        """检测ffmpeg支持的硬件解码方式（cuda/vaapi/qsv/videotoolbox等），结果缓存"""
+        if HardwareAccelerator._HWACCELS_CACHE is not None and not force_refresh:
+            return HardwareAccelerator._HWACCELS_CACHE
+        
+        hwaccels = []
+        try:
+            output = subprocess.check_output(
+                ["ffmpeg", "-hide_banner", "-hwaccels"],
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True
+            )
+            # 第一行是标题"Hardware acceleration methods:"，之后每行一个名称
+            hwaccels = [line.strip() for line in output.splitlines()[1:] if line.strip()]
+            if hwaccels:
+                logger.info(f"✅ 检测到硬件解码支持: {', '.join(hwaccels)}")
+        except Exception as e:
+            logger.warning(f"⚠️ 检测硬件解码支持失败: {str(e)}")
+        
+        HardwareAccelerator._HWACCELS_CACHE = hwaccels
+        return hwaccels
+    
     @staticmethod
     def test_encoder(encoder):
         """测试编码器是否实际可用"""
@@ -174,7 +268,7 @@ class HardwareAccelerator:
         try:
             result = subprocess.run(
                 test_cmd, 
-                stdout=subprocess.PIPE, 
+                stdout=subprocess.DEVNULL, 
                 stderr=subprocess.PIPE,
                 universal_newlines=True,
                 check=False
@@ -247,12 +341,9 @@ class HardwareAccelerator:
             diagnostic_report["issues"].append(f"检查NVIDIA驱动时出错: {str(e)}")
             logger.warning(f"检查NVIDIA驱动时出错: {str(e)}")
         
-        # 2. 检查ffmpeg的NVENC支持
+        # 2. 检查ffmpeg的NVENC支持（复用已缓存的编码器列表，不再单独启动ffmpeg）
         try:
-            ffmpeg_cmd = ["ffmpeg", "-hide_banner", "-encoders"]
-            output = subprocess.check_output(ffmpeg_cmd, universal_newlines=True)
-            
-            if "h264_nvenc" in output:
+            if HardwareAccelerator.detect_available_encoders()["nvidia"]:
                 diagnostic_report["ffmpeg_nvenc_support"] = True
                 logger.info("✅ ffmpeg支持NVENC编码")
             else:
@@ -275,7 +366,7 @@ class HardwareAccelerator:
             try:
                 result = subprocess.run(
                     test_cmd, 
-                    stdout=subprocess.PIPE, 
+                    stdout=subprocess.DEVNULL, 
                     stderr=subprocess.PIPE,
                     universal_newlines=True,
                     check=False
@@ -327,12 +418,41 @@ class HardwareAccelerator:
     
     @staticmethod
     def get_optimal_encoder(preferred_gpu="nvidia", force_diagnostic=False):
-        """获取最优的编码器，并确保它实际可用"""
+        """
+        获取最优的编码器，并确保它实际可用
+        
+        测试编码的结果在进程内缓存，每个视频任务不再重复启动ffmpeg检测；
+        设置环境变量MP_FORCE_ENCODER时直接使用指定的编码器，跳过检测。
+        """
+        forced_encoder = os.getenv("MP_FORCE_ENCODER", "").strip()
+        if forced_encoder:
+            # 只接受libx264或ffmpeg实际支持的硬件编码器，拼写错误或不支持的名称退回自动检测，
+            # 避免错误的编码器名一路传到ffmpeg才失败
+            encoders = HardwareAccelerator.detect_available_encoders()
+            encoder_map = {"nvidia": "h264_nvenc", "intel": "h264_qsv", "amd": "h264_amf"}
+            supported = {"libx264"} | {name for vendor, name in encoder_map.items() if encoders.get(vendor)}
+            if forced_encoder in supported:
+                return forced_encoder
+            logger.warning(f"MP_FORCE_ENCODER={forced_encoder} 不是可用的编码器"
+                           f"（可选: {', '.join(sorted(supported))}），改为自动检测")
+        
         # 如果明确要求诊断，执行完整GPU诊断
         if force_diagnostic:
             diagnostic = HardwareAccelerator.diagnose_gpu_issues()
             return diagnostic["recommended_encoder"]
         
+        cache_key = preferred_gpu.lower()
+        # 加锁避免多个任务同时启动时并发执行测试编码
+        with HardwareAccelerator._OPTIMAL_ENCODER_LOCK:
+            encoder = HardwareAccelerator._OPTIMAL_ENCODER_CACHE.get(cache_key)
+            if encoder is None:
+                encoder = HardwareAccelerator._select_optimal_encoder(preferred_gpu)
+                HardwareAccelerator._OPTIMAL_ENCODER_CACHE[cache_key] = encoder
+        return encoder
+    
+    @staticmethod
+    def _select_optimal_encoder(preferred_gpu):
+        """实际检测并测试编码器，返回可用的最优编码器"""
         encoders = HardwareAccelerator.detect_available_encoders()
         encoder_map = {"nvidia": "h264_nvenc", "intel": "h264_qsv", "amd": "h264_amf"}
         
@@ -352,7 +472,7 @@ class HardwareAccelerator:
                 try:
                     result = subprocess.run(
                         test_cmd, 
-                        stdout=subprocess.PIPE, 
+                        stdout=subprocess.DEVNULL, 
                         stderr=subprocess.PIPE,
                         universal_newlines=True,
                         check=False
@@ -1,16 +1,27 @@
 import os
-import json
 import re
-import subprocess
+import functools
 import shutil
 from loguru import logger
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from app.services.mediainfo import MediaInfoExtractor
 from app.services.ffprobe import FFprobeExtractor
 from app.services.cache_manager import cache_manager
 
 
+@functools.lru_cache(maxsize=1)
+def _load_pyav():
+    """首次读取音频时长时才导入PyAV，避免拖慢本模块的导入；未安装时只提示一次"""
+    try:
+        import av
+        return av
+    except ImportError:
+        logger.warning("⚠️ 未安装PyAV(av)，音频时长改用MediaInfo/FFprobe获取")
+        return None
+
+
 @dataclass
 class VideoBasicMetadata:
     """视频基础元数据"""
@@ -108,6 +119,7 @@ class VideoDetailedMetadata(VideoBasicMetadata):
     bit_depth: int = 0
     color_space: str = ""
     pixel_format: str = ""
+    color_range: str = ""
     audio_codec: str = "unknown"
     audio_channels: int = 0
     audio_sample_rate: int = 0
@@ -135,6 +147,7 @@ class VideoDetailedMetadata(VideoBasicMetadata):
             bit_depth=data.get("bit_depth", 0),
             color_space=data.get("color_space", ""),
             pixel_format=data.get("pixel_format", ""),
+            color_range=data.get("color_range", ""),
             audio_codec=data.get("audio_codec", "unknown"),
             audio_channels=data.get("audio_channels", 0),
             audio_sample_rate=data.get("audio_sample_rate", 0),
@@ -152,6 +165,7 @@ class VideoDetailedMetadata(VideoBasicMetadata):
             "bit_depth": self.bit_depth,
             "color_space": self.color_space,
             "pixel_format": self.pixel_format,
+            "color_range": self.color_range,
             "audio_codec": self.audio_codec,
             "audio_channels": self.audio_channels,
             "audio_sample_rate": self.audio_sample_rate,
@@ -184,22 +198,8 @@ class VideoMetadataExtractor:
         Returns:
             标准化后的旋转角度 (0, 90, 180, 270)
         """
-        # 将角度四舍五入到最接近的90度倍数
-        normalized_rotation = ((rotation + 45) // 90 * 90) % 360
-        
-        # 确保角度为 0, 90, 180, 270
-        if normalized_rotation not in [0, 90, 180, 270]:
-            # 安全处理：如果仍然不是标准角度，使用最接近的90度角
-            if normalized_rotation < 45:
-                normalized_rotation = 0
-            elif normalized_rotation < 135:
-                normalized_rotation = 90
-            elif normalized_rotation < 225:
-                normalized_rotation = 180
-            else:
-                normalized_rotation = 270
-        
-        return normalized_rotation
+        # 与提取阶段使用同一套规则，避免两处取整方式不一致
+        return FFprobeExtractor.normalize_rotation(rotation)
     
     @staticmethod
     def get_basic_metadata(video_path: str) -> VideoBasicMetadata:
@@ -253,9 +253,6 @@ class VideoMetadataExtractor:
                 aspect_ratio=0.0, duration=0.0
             )
         
-        # MOV格式特殊处理 - 确保正确提取旋转信息
-        is_mov_format = video_path.lower().endswith('.mov')
-        
         # 尝试从缓存获取
         cached_data = cache_manager.get_metadata(video_path, "detailed")
         if cached_data:
@@ -266,6 +263,19 @@ class VideoMetadataExtractor:
             if VideoMetadataExtractor.is_mediainfo_available():
                 logger.info("✅ 使用MediaInfo获取视频元数据")
                 metadata_dict = MediaInfoExtractor.get_detailed_metadata(video_path)
+                
+                # MediaInfo有时读不到MOV的旋转信息，用ffprobe的旋转查询补充；
+                # FFprobe提取时已用同一套规则解析过视频流的rotate标签和Display Matrix，无需重复检查
+                if video_path.lower().endswith('.mov') and not metadata_dict.get("rotation"):
+                    rotation = FFprobeExtractor.extract_rotation(video_path)
+                    if rotation:
+                        logger.info(f"从MOV元数据中提取到旋转角度: {rotation}°")
+                        metadata_dict["rotation"] = rotation
+                        # 更新有效宽高，考虑旋转因素
+                        if rotation in [90, 270]:
+                            metadata_dict["effective_width"] = metadata_dict.get("height", 0)
+                            metadata_dict["effective_height"] = metadata_dict.get("width", 0)
+                            metadata_dict["is_portrait"] = metadata_dict["effective_height"] > metadata_dict["effective_width"]
             else:
                 logger.info("⚠️ MediaInfo不可用，使用FFprobe获取视频元数据")
                 metadata_dict = FFprobeExtractor.get_detailed_metadata(video_path)
@@ -276,62 +286,28 @@ class VideoMetadataExtractor:
             # 返回对象实例而不是字典
             metadata = VideoDetailedMetadata.from_dict(metadata_dict)
         
-        # 对MOV格式进行额外的旋转角度检查
-        if is_mov_format:
-            # 首先检查已有的旋转角度
-            if metadata.rotation == 0:
-                # 尝试不同的元数据提取方式获取旋转信息
-                try:
-                    # 方法1: 检查流标签中的rotate信息
-                    rotation_cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", 
-                                   "-show_entries", "stream_tags=rotate", "-of", "json", video_path]
-                    rotation_output = subprocess.check_output(rotation_cmd, universal_newlines=True)
-                    rotation_data = json.loads(rotation_output)
-                    
-                    if "streams" in rotation_data and rotation_data["streams"] and "tags" in rotation_data["streams"][0]:
-                        tags = rotation_data["streams"][0]["tags"]
-                        if "rotate" in tags:
-                            rotation = int(tags["rotate"])
-                            # 更新元数据中的旋转角度
-                            metadata.rotation = VideoMetadataExtractor.normalize_rotation(rotation)
-                            logger.info(f"从MOV流标签中提取到旋转角度: {rotation}°")
-                            
-                            # 更新有效宽高，考虑旋转因素
-                            if metadata.rotation in [90, 270]:
-                                metadata.effective_width, metadata.effective_height = metadata.height, metadata.width
-                            
-                            # 重新缓存更新后的元数据
-                            cache_manager.set_metadata(video_path, "detailed", metadata)
-                except Exception as e:
-                    logger.warning(f"从MOV标签获取旋转信息时出错: {str(e)}")
-                    
-                # 方法2: 如果第一种方法失败，检查QuickTime元数据
-                if metadata.rotation == 0:
-                    try:
-                        qt_cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", 
-                                 "-show_entries", "stream_side_data=rotation", "-of", "json", video_path]
-                        qt_output = subprocess.check_output(qt_cmd, universal_newlines=True)
-                        qt_data = json.loads(qt_output)
-                        
-                        if "streams" in qt_data and qt_data["streams"] and "side_data_list" in qt_data["streams"][0]:
-                            for side_data in qt_data["streams"][0]["side_data_list"]:
-                                if "rotation" in side_data:
-                                    rotation = float(side_data["rotation"])
-                                    metadata.rotation = VideoMetadataExtractor.normalize_rotation(rotation)
-                                    logger.info(f"从QuickTime元数据中提取到旋转角度: {rotation}°")
-                                    
-                                    # 更新有效宽高
-                                    if metadata.rotation in [90, 270]:
-                                        metadata.effective_width, metadata.effective_height = metadata.height, metadata.width
-                                    
-                                    # 重新缓存更新后的元数据
-                                    cache_manager.set_metadata(video_path, "detailed", metadata)
-                                    break
-                    except Exception as e:
-                        logger.warning(f"从QuickTime元数据获取旋转信息时出错: {str(e)}")
-        
         return metadata
     
+    @staticmethod
+    def prefetch_metadata(video_paths: List[str], max_workers: int = 8) -> None:
+        """
+        并发获取多个视频的元数据并写入缓存
+        
+        多个探测进程同时运行，磁盘读取和进程启动的等待时间相互重叠；
+        之后逐个调用get_video_metadata时直接命中缓存。
+        
+        Args:
+            video_paths: 视频文件路径列表
+            max_workers: 最大并发探测数
+        """
+        paths = [path for path in dict.fromkeys(video_paths) if path and os.path.exists(path)]
+        if len(paths) < 2:
+            return
+        
+        logger.info(f"🚀 并发预取 {len(paths)} 个视频的元数据")
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+            list(executor.map(VideoMetadataExtractor.get_video_metadata, paths))
+    
     @staticmethod
     def get_audio_duration(audio_path: str) -> float:
         """获取音频文件时长"""
@@ -343,12 +319,14 @@ class VideoMetadataExtractor:
         
         # 尝试从缓存获取
         cached_data = cache_manager.get_metadata(audio_path, "basic")
-        if cached_data and "duration" in cached_data:
-            return float(cached_data["duration"])
+        if cached_data and cached_data.get("duration"):
+            return float(cached_data.get("duration"))
         
-        # 缓存未命中，从提取器获取
-        duration = 0.0
-        if VideoMetadataExtractor.is_mediainfo_available():
+        # 缓存未命中：优先用PyAV在进程内读取容器时长，无需启动外部进程
+        duration = VideoMetadataExtractor._get_audio_duration_pyav(audio_path)
+        if duration > 0:
+            logger.info("✅ 使用PyAV获取音频时长")
+        elif VideoMetadataExtractor.is_mediainfo_available():
             logger.info("✅ 使用MediaInfo获取音频时长")
             duration = MediaInfoExtractor.get_audio_duration(audio_path)
         else:
@@ -360,6 +338,38 @@ class VideoMetadataExtractor:
         
         return duration
     
+    @staticmethod
+    def _get_audio_duration_pyav(audio_path: str) -> float:
+        """用PyAV读取音频时长，PyAV不可用或容器未记录时长时返回0.0"""
+        av = _load_pyav()
+        if av is None:
+            return 0.0
+        try:
+            with av.open(audio_path) as container:
+                if container.duration:
+                    return container.duration / av.time_base
+        except Exception as e:
+            logger.warning(f"⚠️ PyAV读取音频时长失败: {str(e)}")
+        return 0.0
+    
+    @staticmethod
+    def get_h264_parameters(video_path: str) -> Optional[Tuple[str, int, str]]:
+        """获取H.264视频流的(profile, level, extradata校验值)，用于判断多个素材能否流复制合并"""
+        if not os.path.exists(video_path):
+            logger.error(f"❌ 文件不存在: {video_path}")
+            return None
+        
+        return FFprobeExtractor.get_h264_parameters(video_path)
+    
+    @staticmethod
+    def get_keyframe_times(video_path: str) -> List[float]:
+        """获取视频关键帧时间点（秒，升序），用于流复制截取时对齐入点"""
+        if not os.path.exists(video_path):
+            logger.error(f"❌ 文件不存在: {video_path}")
+            return []
+        
+        return FFprobeExtractor.get_keyframe_times(video_path)
+    
     @staticmethod
     def get_video_framerate(video_path: str) -> float:
         """获取视频帧率"""
@@ -404,6 +414,35 @@ class VideoMetadataExtractor:
         logger.info(f"🎬 视频编码: {codec}")
         return codec
     
+    @staticmethod
+    def needs_pixel_format_conversion(metadata) -> bool:
+        """
+        判断视频是否需要转换为yuv420p
+        
+        源已经是8位4:2:0时编码器可以直接使用，省去format滤镜的逐帧转换；
+        10位、4:2:2/4:4:4、全范围(yuvj)或未知格式仍需转换。
+        """
+        pixel_format = str(getattr(metadata, "pixel_format", "") or "").lower()
+        color_range = str(getattr(metadata, "color_range", "") or "").lower()
+        bit_depth = getattr(metadata, "bit_depth", 0) or 0
+        
+        if bit_depth not in (0, 8):
+            return True
+        
+        # ffprobe的色彩范围为tv/pc，mediainfo为Limited/Full
+        if color_range in ("pc", "full"):
+            return True
+        
+        # ffprobe返回pix_fmt，全范围源为yuvj420p，与yuv420p可以直接区分
+        if pixel_format == "yuv420p":
+            return False
+        
+        # mediainfo只返回色度采样，"4:2:0"无法区分是否全范围，只有明确标记为有限范围时才跳过转换
+        if pixel_format == "4:2:0":
+            return color_range != "limited"
+        
+        return True
+    
     @staticmethod
     def is_portrait_by_metadata(width: int, height: int, rotation: int) -> bool:
         """根据视频的宽、高和旋转角度判断视频是否为竖屏"""
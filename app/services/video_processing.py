@@ -1,5 +1,4 @@
 import os
-import json
 import subprocess
 from loguru import logger
 from app.services.video_metadata import VideoMetadataExtractor, VideoDetailedMetadata
@@ -1210,6 +1210,11 @@ def _format_text(text: str) -> str:
     return text
 
 
+# 字幕对齐时每个片段都要做两次归一化，正则只编译一次
+_NON_WORD_SPACE_RE = re.compile(r"[^\w\s]")
+_NON_WORD_RE = re.compile(r"\W+")
+
+
 def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str):
     """
     优化字幕文件
@@ -1235,8 +1240,11 @@ def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str)
     sub_index = 0
 
     script_lines = utils.split_string_by_punctuations(text)
+    # 脚本行的两种归一化形式只计算一次，避免每个字幕片段都重复处理
+    script_lines_punct = [_NON_WORD_SPACE_RE.sub("", _line) for _line in script_lines]
+    script_lines_word = [_NON_WORD_RE.sub("", _line) for _line in script_lines]
 
-    def match_line(_sub_line: str, _sub_index: int):
+    def match_line(_sub_line: str, _sub_line_punct: str, _sub_line_word: str, _sub_index: int):
         if len(script_lines) <= _sub_index:
             return ""
 
@@ -1244,19 +1252,19 @@ def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str)
         if _sub_line == _line:
             return script_lines[_sub_index].strip()
 
-        _sub_line_ = re.sub(r"[^\w\s]", "", _sub_line)
-        _line_ = re.sub(r"[^\w\s]", "", _line)
-        if _sub_line_ == _line_:
+        _line_ = script_lines_punct[_sub_index]
+        if _sub_line_punct == _line_:
             return _line_.strip()
 
-        _sub_line_ = re.sub(r"\W+", "", _sub_line)
-        _line_ = re.sub(r"\W+", "", _line)
-        if _sub_line_ == _line_:
+        if _sub_line_word == script_lines_word[_sub_index]:
             return _line.strip()
 
         return ""
 
+    # 逐字符过滤的结果可以按片段累加，只需处理新加入的片段，无需反复扫描整行
     sub_line = ""
+    sub_line_punct = ""
+    sub_line_word = ""
 
     try:
         for _, (offset, sub) in enumerate(zip(sub_maker.offset, sub_maker.subs)):
@@ -1266,7 +1274,9 @@ def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str)
 
             sub = unescape(sub)
             sub_line += sub
-            sub_text = match_line(sub_line, sub_index)
+            sub_line_punct += _NON_WORD_SPACE_RE.sub("", sub)
+            sub_line_word += _NON_WORD_RE.sub("", sub)
+            sub_text = match_line(sub_line, sub_line_punct, sub_line_word, sub_index)
             if sub_text:
                 sub_index += 1
                 line = formatter(
@@ -1278,6 +1288,8 @@ def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str)
                 sub_items.append(line)
                 start_time = -1.0
                 sub_line = ""
+                sub_line_punct = ""
+                sub_line_word = ""
 
         if len(sub_items) == len(script_lines):
             with open(subtitle_file, "w", encoding="utf-8") as file:
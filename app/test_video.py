@@ -0,0 +1,284 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# 添加项目根目录到路径，以便导入正常工作
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(current_dir)
+sys.path.append(root_dir)
+
+from app.models.schema import VideoConcatMode, VideoParams
+from app.services import video
+from app.services.video_metadata import VideoDetailedMetadata
+
+
+def _job(path="a.mp4", duration=5.0, can_copy=True, framerate=60.0):
+    """构造combine_videos规划阶段生成的片段任务"""
+    return {
+        "video_path": path,
+        "segment_duration": duration,
+        "can_copy": can_copy,
+        "framerate": framerate,
+    }
+
+
+@pytest.fixture
+def five_second_jobs():
+    return [_job(f"clip_{i}.mp4") for i in range(10)]
+
+
+@pytest.mark.parametrize("audio_duration, expected_count", [
+    (4.0, 2),    # 第一个片段即可覆盖，另留一个余量
+    (10.0, 3),   # 恰好落在第二个片段结尾
+    (10.1, 4),
+    (49.0, 10),  # 所需片段数超过已规划数量时全部保留
+    (100.0, 10),
+])
+def test_select_segment_jobs_truncates_at_audio_duration(five_second_jobs, audio_duration, expected_count):
+    selected = video._select_segment_jobs(five_second_jobs, audio_duration, VideoConcatMode.sequential)
+
+    assert selected == five_second_jobs[:expected_count]
+
+
+def test_select_segment_jobs_random_mode_keeps_input_list(five_second_jobs):
+    original = list(five_second_jobs)
+
+    selected = video._select_segment_jobs(five_second_jobs, 12.0, VideoConcatMode.random)
+
+    assert five_second_jobs == original
+    assert len(selected) == 4
+    assert all(job in original for job in selected)
+
+
+def test_pad_concat_entries_cycles_short_sources():
+    entries = [("a.mp4", None, None), ("b.mp4", None, None)]
+
+    padded = video._pad_concat_entries(entries, [3.0, 2.0], audio_duration=12.0)
+
+    assert padded == entries * 2 + [entries[0]]
+    assert entries == [("a.mp4", None, None), ("b.mp4", None, None)]
+
+
+def test_pad_concat_entries_random_mode_covers_audio():
+    entries = [("a.mp4", 0.0, 2.0), ("b.mp4", 1.0, 3.0), ("c.mp4", 0.0, 2.0)]
+    durations = {entry: 2.0 for entry in entries}
+
+    padded = video._pad_concat_entries(entries, [2.0] * 3, audio_duration=15.0, shuffle=True)
+
+    assert padded[:3] == entries
+    assert sum(durations[entry] for entry in padded) >= 15.0
+    assert sum(durations[entry] for entry in padded[:-1]) < 15.0
+
+
+@pytest.mark.parametrize("durations, audio_duration", [
+    ([5.0, 5.0], 10.0),  # 已经足够
+    ([0.0, 0.0], 10.0),  # 没有有效时长时不补足，避免死循环
+])
+def test_pad_concat_entries_leaves_entries_unchanged(durations, audio_duration):
+    entries = [("a.mp4", None, None), ("b.mp4", None, None)]
+
+    assert video._pad_concat_entries(entries, durations, audio_duration) == entries
+
+
+@pytest.mark.parametrize("jobs, expected", [
+    ([_job("a.mp4"), _job("b.mp4")], True),
+    ([_job("a.mp4"), _job("b.mp4", framerate=25.0)], False),
+    ([_job("a.mp4", framerate=30.0), _job("b.mp4", framerate=30.0)], False),  # 帧率一致但不是目标帧率
+    ([_job("a.mp4"), _job("image.png.mp4", framerate=15.0)], False),  # 15fps的图片片段
+    ([_job("a.mp4"), _job("b.mp4", can_copy=False)], False),
+    ([], False),
+])
+def test_jobs_allow_stream_copy(jobs, expected):
+    assert video._jobs_allow_stream_copy(jobs) is expected
+
+
+@pytest.mark.parametrize("parameters, expected", [
+    ([("High", 40, "CRC32:1a2b"), ("High", 40, "CRC32:1a2b")], True),
+    ([("High", 40, "CRC32:1a2b"), ("Main", 40, "CRC32:1a2b")], False),
+    ([("High", 40, "CRC32:1a2b"), ("High", 41, "CRC32:1a2b")], False),
+    ([("High", 40, "CRC32:1a2b"), ("High", 40, "CRC32:ffff")], False),
+    ([("High", 40, "CRC32:1a2b"), None], False),
+    ([], False),
+])
+def test_h264_parameters_match(parameters, expected):
+    assert video._h264_parameters_match(parameters) is expected
+
+
+def _box(box_type: bytes, payload: bytes = b"", declared_size: int = None) -> bytes:
+    """构造一个MP4盒，declared_size用于模拟长度字段与实际内容不符（文件被截断）"""
+    size = declared_size if declared_size is not None else 8 + len(payload)
+    return size.to_bytes(4, "big") + box_type + payload
+
+
+FTYP = _box(b"ftyp", b"isom\x00\x00\x02\x00isomiso2avc1mp41")
+
+
+@pytest.mark.parametrize("content, expected", [
+    (FTYP + _box(b"mdat", b"\x00" * 64) + _box(b"moov", b"\x00" * 32), True),
+    (FTYP + _box(b"moov", b"\x00" * 32) + _box(b"mdat", b"\x00" * 64), True),  # faststart
+    (FTYP + _box(b"moov"), True),  # 很小但结构完整的文件
+    (FTYP + _box(b"free") + _box(b"moov") + _box(b"mdat", declared_size=0) + b"\x00" * 16, True),
+    (FTYP + (1).to_bytes(4, "big") + b"mdat" + (24).to_bytes(8, "big") + b"\x00" * 8 + _box(b"moov"), True),
+    (FTYP + _box(b"mdat", b"\x00" * 64), False),  # 写到一半中断，缺少moov
+    (FTYP + _box(b"moov") + _box(b"mdat", b"\x00" * 64, declared_size=4096), False),  # mdat被截断
+    (FTYP + _box(b"mdat", b"\x00" * 64) + _box(b"moov", b"\x00" * 8, declared_size=64), False),  # moov被截断
+    (FTYP[:10], False),
+    (_box(b"moov") + FTYP, False),  # 不是以ftyp开头
+    (b"", False),
+])
+def test_is_valid_mp4(tmp_path, content, expected):
+    path = tmp_path / "out.mp4"
+    path.write_bytes(content)
+
+    assert video._is_valid_mp4(str(path)) is expected
+
+
+def test_is_valid_mp4_missing_file(tmp_path):
+    assert video._is_valid_mp4(str(tmp_path / "missing.mp4")) is False
+
+
+def test_combine_single_video_falls_back_to_libx264(tmp_path, monkeypatch):
+    """单素材快速路径与多素材路径一样使用检测到的硬件编码器，失败时改用libx264重试"""
+    metadata = VideoDetailedMetadata(width=1920, height=1080, codec="h264", duration=30.0,
+                                     framerate=30.0, pixel_format="yuv420p")
+    commands = []
+
+    def fake_run(cmd, input=None):
+        commands.append(cmd)
+        return (1, "nvenc unavailable") if "h264_nvenc" in cmd else (0, "")
+
+    monkeypatch.setattr(video.VideoMetadataExtractor, "get_video_metadata", staticmethod(lambda path: metadata))
+    monkeypatch.setattr(video.HardwareAccelerator, "get_optimal_encoder", staticmethod(lambda: "h264_nvenc"))
+    monkeypatch.setattr(video, "_run_ffmpeg_bounded", fake_run)
+    monkeypatch.setattr(video, "_is_valid_mp4", lambda path: True)
+    output = str(tmp_path / "combined.mp4")
+
+    result = video._combine_single_video("in.mp4", "voice.mp3", 10.0, 1080, 1920, "scale=1080:1920", output)
+
+    assert result == output
+    assert len(commands) == 2
+    assert commands[0][commands[0].index("-c:v") + 1] == "h264_nvenc"
+    assert commands[1][commands[1].index("-c:v") + 1] == "libx264"
+    assert commands[1][commands[1].index("-r") + 1] == str(video._SEGMENT_FPS)
+
+
+def _av_get_token(text: str, term: str):
+    """按ffmpeg av_get_token的规则读取一个记号：反斜杠转义下一个字符，单引号内原样保留，遇到term中的字符结束"""
+    token = []
+    i = 0
+    while i < len(text) and text[i] not in term:
+        if text[i] == "\\" and i + 1 < len(text):
+            token.append(text[i + 1])
+            i += 2
+        elif text[i] == "'":
+            end = text.index("'", i + 1)
+            token.append(text[i + 1:end])
+            i = end + 1
+        else:
+            token.append(text[i])
+            i += 1
+    return "".join(token), text[i:]
+
+
+def _parse_filter_value(escaped: str) -> str:
+    """模拟ffmpeg先按滤镜图、再按选项值两级解析"""
+    graph_level, _ = _av_get_token(escaped, "[],;")
+    value, _ = _av_get_token(graph_level, ":")
+    return value
+
+
+@pytest.mark.parametrize("value", [
+    "/tmp/subtitle.srt",
+    "C:/Users/me/Videos/subtitle.srt",
+    "/tmp/it's a test/subtitle.srt",
+    "/tmp/a:b/sub\\title.srt",
+    "/tmp/[draft], v1; final/subtitle.srt",
+    "D:/素材/字幕 文件.srt",
+])
+def test_escape_filter_value_roundtrips(value):
+    assert _parse_filter_value(video._escape_filter_value(value)) == value
+
+
+def test_escape_filter_value_windows_drive():
+    # 选项值级转义冒号，滤镜图级再转义该反斜杠
+    assert video._escape_filter_value("C:/sub.srt") == r"C\\:/sub.srt"
+
+
+def test_escape_filter_path_uses_absolute_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    escaped = video._escape_filter_path("subtitle.srt")
+
+    assert _parse_filter_value(escaped) == str(tmp_path / "subtitle.srt")
+
+
+def test_escape_filter_path_windows(monkeypatch):
+    monkeypatch.setattr(video.os, "name", "nt")
+    monkeypatch.setattr(video.os.path, "abspath", lambda path: "C:\\Users\\me\\sub.srt")
+
+    assert _parse_filter_value(video._escape_filter_path("sub.srt")) == "C:/Users/me/sub.srt"
+
+
+@pytest.mark.parametrize("position, alignment", [("bottom", 2), ("top", 8), ("center", 5)])
+def test_build_subtitle_filter(tmp_path, position, alignment):
+    params = VideoParams(video_subject="test", subtitle_position=position, font_name="Noto Sans: CJK",
+                         font_size=48, text_fore_color="#FFFFFF", stroke_color="#000000", stroke_width=1.5)
+    subtitle_path = str(tmp_path / "it's.srt")
+
+    subtitle_filter = video._build_subtitle_filter(subtitle_path, params)
+
+    assert subtitle_filter.startswith("subtitles=")
+    filename, rest = _av_get_token(_av_get_token(subtitle_filter[len("subtitles="):], "[],;")[0], ":")
+    assert filename == subtitle_path
+    key, style = rest[1:].split("=", 1)
+    assert key == "force_style"
+    assert _av_get_token(style, ":")[0] == ("FontName=Noto Sans: CJK,FontSize=48,PrimaryColour=&HFFFFFF&,OutlineColour=&H000000&,"
+                     f"BorderStyle=1,Outline=1.5,Alignment={alignment},MarginV=50")
+
+
+@pytest.fixture
+def bgm_dir(tmp_path):
+    video._scan_bgm_files.cache_clear()
+    song_dir = tmp_path / "songs"
+    song_dir.mkdir()
+    (song_dir / "a.mp3").write_bytes(b"")
+    (song_dir / "cover.jpg").write_bytes(b"")
+    yield song_dir
+    video._scan_bgm_files.cache_clear()
+
+
+def test_list_bgm_files_cached_until_directory_changes(bgm_dir, monkeypatch):
+    scans = []
+    real_glob = video.glob.glob
+    monkeypatch.setattr(video.glob, "glob", lambda pattern: scans.append(pattern) or real_glob(pattern))
+
+    assert video._list_bgm_files(str(bgm_dir)) == (str(bgm_dir / "a.mp3"),)
+    assert video._list_bgm_files(str(bgm_dir)) == (str(bgm_dir / "a.mp3"),)
+    assert len(scans) == 1
+
+    (bgm_dir / "b.mp3").write_bytes(b"")
+    # 部分文件系统的修改时间精度较低，显式修改目录时间确保缓存键变化
+    stat = os.stat(bgm_dir)
+    os.utime(bgm_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert sorted(video._list_bgm_files(str(bgm_dir))) == [str(bgm_dir / "a.mp3"), str(bgm_dir / "b.mp3")]
+    assert len(scans) == 2
+
+
+def test_list_bgm_files_missing_directory(tmp_path):
+    assert video._list_bgm_files(str(tmp_path / "missing")) == ()
+
+
+def test_list_bgm_files_concurrent_access(bgm_dir):
+    for i in range(20):
+        (bgm_dir / f"song_{i}.mp3").write_bytes(b"")
+    expected = sorted(str(path) for path in bgm_dir.glob("*.mp3"))
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(lambda _: video._list_bgm_files(str(bgm_dir)), range(200)))
+
+    assert all(sorted(result) == expected for result in results)
+    assert all(isinstance(result, tuple) for result in results)
+    assert video._scan_bgm_files.cache_info().currsize == 1
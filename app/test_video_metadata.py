@@ -0,0 +1,90 @@
+import os
+import sys
+
+import pytest
+
+# 添加项目根目录到路径，以便导入正常工作
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(current_dir)
+sys.path.append(root_dir)
+
+from app.services.ffprobe import FFprobeExtractor
+from app.services.mediainfo import MediaInfoExtractor
+from app.services.video_metadata import VideoDetailedMetadata, VideoMetadataExtractor
+
+
+def _ffprobe_output(pix_fmt, color_range=None, bits=None):
+    """构造ffprobe -show_format -show_streams的输出"""
+    stream = {
+        "codec_type": "video",
+        "codec_name": "h264",
+        "width": 1080,
+        "height": 1920,
+        "r_frame_rate": "30/1",
+        "pix_fmt": pix_fmt,
+    }
+    if color_range:
+        stream["color_range"] = color_range
+    if bits:
+        stream["bits_per_raw_sample"] = str(bits)
+    return {"format": {"duration": "5.0"}, "streams": [stream]}
+
+
+def _mediainfo_output(chroma, colour_range=None, bit_depth="8"):
+    """构造mediainfo --Output=JSON的输出"""
+    video_track = {
+        "@type": "Video",
+        "Format": "AVC",
+        "Width": "1080",
+        "Height": "1920",
+        "FrameRate": "30.000",
+        "BitDepth": bit_depth,
+        "ChromaSubsampling": chroma,
+    }
+    if colour_range:
+        video_track["colour_range"] = colour_range
+    return {"media": {"track": [{"@type": "General", "Duration": "5.0"}, video_track]}}
+
+
+@pytest.mark.parametrize("output, expected", [
+    (_ffprobe_output("yuv420p", "tv"), False),
+    (_ffprobe_output("yuv420p"), False),
+    (_ffprobe_output("yuvj420p", "pc"), True),
+    (_ffprobe_output("yuv420p", "pc"), True),
+    (_ffprobe_output("yuv420p10le", "tv", bits=10), True),
+    (_ffprobe_output("yuv422p", "tv"), True),
+])
+def test_pixel_format_conversion_ffprobe(tmp_path, monkeypatch, output, expected):
+    """ffprobe后端：按pix_fmt和color_range判断"""
+    video_path = tmp_path / "clip.mp4"
+    video_path.write_bytes(os.urandom(16))
+    monkeypatch.setattr(FFprobeExtractor, "_execute_ffprobe", staticmethod(lambda *args, **kwargs: output))
+
+    metadata = VideoDetailedMetadata.from_dict(FFprobeExtractor.get_detailed_metadata(str(video_path)))
+
+    assert VideoMetadataExtractor.needs_pixel_format_conversion(metadata) is expected
+
+
+@pytest.mark.parametrize("output, expected", [
+    (_mediainfo_output("4:2:0", "Limited"), False),
+    (_mediainfo_output("4:2:0", "Full"), True),
+    (_mediainfo_output("4:2:0"), True),
+    (_mediainfo_output("4:2:0", "Limited", bit_depth="10"), True),
+    (_mediainfo_output("4:2:2", "Limited"), True),
+])
+def test_pixel_format_conversion_mediainfo(tmp_path, monkeypatch, output, expected):
+    """mediainfo后端：只有色度采样，未标明有限范围的4:2:0也需要转换"""
+    video_path = tmp_path / "clip.mp4"
+    video_path.write_bytes(b"")
+    monkeypatch.setattr(MediaInfoExtractor, "_execute_mediainfo", staticmethod(lambda *args, **kwargs: output))
+
+    metadata = VideoDetailedMetadata.from_dict(MediaInfoExtractor.get_detailed_metadata(str(video_path)))
+
+    assert VideoMetadataExtractor.needs_pixel_format_conversion(metadata) is expected
+
+
+def test_color_range_survives_cache_roundtrip():
+    """color_range需要随元数据一起写入和读出缓存"""
+    metadata = VideoDetailedMetadata(pixel_format="4:2:0", color_range="Full")
+
+    assert VideoDetailedMetadata.from_dict(metadata.to_dict()).color_range == "Full"
@@ -0,0 +1,125 @@
+import os
+import re
+import sys
+from xml.sax.saxutils import unescape
+
+import pytest
+
+# 添加项目根目录到路径，以便导入正常工作
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(current_dir)
+sys.path.append(root_dir)
+
+from edge_tts import SubMaker
+from edge_tts.submaker import mktimestamp
+from moviepy.video.tools import subtitles
+
+from app.services import voice
+from app.utils import utils
+
+
+def _create_subtitle_baseline(sub_maker: SubMaker, text: str, subtitle_file: str):
+    """优化前的create_subtitle（每次都对整行重新做两种归一化），作为对照保留"""
+    text = voice._format_text(text)
+
+    def formatter(idx: int, start_time: float, end_time: float, sub_text: str) -> str:
+        start_t = mktimestamp(start_time).replace(".", ",")
+        end_t = mktimestamp(end_time).replace(".", ",")
+        return f"{idx}\n" f"{start_t} --> {end_t}\n" f"{sub_text}\n"
+
+    start_time = -1.0
+    sub_items = []
+    sub_index = 0
+
+    script_lines = utils.split_string_by_punctuations(text)
+
+    def match_line(_sub_line: str, _sub_index: int):
+        if len(script_lines) <= _sub_index:
+            return ""
+
+        _line = script_lines[_sub_index]
+        if _sub_line == _line:
+            return script_lines[_sub_index].strip()
+
+        _sub_line_ = re.sub(r"[^\w\s]", "", _sub_line)
+        _line_ = re.sub(r"[^\w\s]", "", _line)
+        if _sub_line_ == _line_:
+            return _line_.strip()
+
+        _sub_line_ = re.sub(r"\W+", "", _sub_line)
+        _line_ = re.sub(r"\W+", "", _line)
+        if _sub_line_ == _line_:
+            return _line.strip()
+
+        return ""
+
+    sub_line = ""
+
+    for _, (offset, sub) in enumerate(zip(sub_maker.offset, sub_maker.subs)):
+        _start_time, end_time = offset
+        if start_time < 0:
+            start_time = _start_time
+
+        sub = unescape(sub)
+        sub_line += sub
+        sub_text = match_line(sub_line, sub_index)
+        if sub_text:
+            sub_index += 1
+            sub_items.append(formatter(sub_index, start_time, end_time, sub_text))
+            start_time = -1.0
+            sub_line = ""
+
+    if len(sub_items) == len(script_lines):
+        with open(subtitle_file, "w", encoding="utf-8") as file:
+            file.write("\n".join(sub_items) + "\n")
+        try:
+            sbs = subtitles.file_to_subtitles(subtitle_file, encoding="utf-8")
+            max([tb for ((ta, tb), txt) in sbs])
+        except Exception:
+            os.remove(subtitle_file)
+
+
+def _sub_maker(subs):
+    """按每个片段0.5秒构造edge_tts的字幕数据（时间单位为100纳秒）"""
+    sub_maker = SubMaker()
+    sub_maker.subs = list(subs)
+    sub_maker.offset = [(i * 5_000_000, (i + 1) * 5_000_000) for i in range(len(subs))]
+    return sub_maker
+
+
+def _read(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("text, subs, expected_lines", [
+    # 标点：TTS返回的片段不带标点
+    ("你好，世界！今天天气很好。", ["你好", "世界", "今天", "天气", "很好"], 3),
+    # 标点：片段自带标点
+    ("你好，世界！今天天气很好。", ["你好，", "世界！", "今天天气", "很好。"], 3),
+    # 中英文混排
+    ("Hello, world! 我们使用Python编程。", ["Hello", "world", "我们", "使用", "Python", "编程"], 3),
+    ("Hello, world! 我们使用Python编程。", ["Hello, ", "world! ", "我们使用", "Python", "编程。"], 3),
+    # XML转义字符
+    ("Tom & Jerry < Spike.", ["Tom", " &amp;", " Jerry", " &lt;", " Spike"], 1),
+    # 数字中的标点
+    ("数字1,234和5.6%。", ["数字", "1,234", "和", "5.6%"], 0),
+    # 匹配不上时不生成字幕文件
+    ("第一句。第二句。", ["第一句", "别的"], 0),
+    # 空字符串
+    ("", [], 0),
+])
+def test_create_subtitle_matches_baseline(tmp_path, text, subs, expected_lines):
+    baseline_file = str(tmp_path / "baseline.srt")
+    optimized_file = str(tmp_path / "optimized.srt")
+
+    _create_subtitle_baseline(_sub_maker(subs), text, baseline_file)
+    voice.create_subtitle(_sub_maker(subs), text, optimized_file)
+
+    assert _read(optimized_file) == _read(baseline_file)
+    if expected_lines:
+        assert _read(optimized_file).count(" --> ") == expected_lines
+    else:
+        assert _read(optimized_file) is None